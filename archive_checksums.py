@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+'''
+md5 and sha256 checksums of the files in a web application zip or
+tarball, hashed straight from the archive without extracting it
+'''
+
+import tarfile
+import tempfile
+import urllib2
+import zipfile
+from file_hashing import CHUNK_SIZE, digests_fileobj
+
+# zips bigger than this are spooled to an unlinked temp file, not memory
+SPOOL_SIZE = 64 * 1024 * 1024
+# seconds to wait on a stalled download before giving up on it
+DOWNLOAD_TIMEOUT = 60
+# HTTP statuses that mean the server doesn't have the archive
+NOT_FOUND = (404, 410)
+
+class _TeeReader(object):
+    '''
+    file object that copies everything read from f into copy_to
+    '''
+    def __init__(self, f, copy_to):
+        self.f = f
+        self.copy_to = copy_to
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.copy_to.write(data)
+        return data
+
+    def close(self):
+        '''
+        tarfile stops at the end-of-archive marker, copy whatever is left
+        '''
+        while self.read(CHUNK_SIZE):
+            pass
+        self.copy_to.close()
+        self.f.close()
+
+def download_archive(url, keep_file=None):
+    '''
+    Open url as a file object for archive_md5sums(), or None if the
+    server doesn't have it - other failures raise. One request both checks that the archive
+    exists and downloads it.
+
+    Tarballs are hashed as they stream in. Zips keep their index at the
+    end so they are spooled first, but are never extracted.
+    keep_file: also save the archive under this name
+    A connection or read that stalls for DOWNLOAD_TIMEOUT raises an error.
+    Close the returned file object when done with it.
+    '''
+    try:
+        handler = urllib2.urlopen( urllib2.Request(url), timeout=DOWNLOAD_TIMEOUT )
+    except urllib2.HTTPError as e:
+        if e.code in NOT_FOUND:
+            return None
+        # e.g. a 503 from a busy mirror, the archive may well be there
+        raise
+    if not handler.getcode() == 200:
+        raise Exception('error retrieving ' + url)
+    if keep_file:
+        handler = _TeeReader(handler, open(keep_file, 'wb'))
+    if not url.endswith('.zip'):
+        return handler
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    while True:
+        data = handler.read(CHUNK_SIZE)
+        if not data:
+            break
+        spool.write(data)
+    handler.close()
+    spool.seek(0)
+    return spool
+
+def _zip_members(archive):
+    zf = zipfile.ZipFile(archive)
+    try:
+        for info in zf.infolist():
+            if info.filename.endswith('/'):
+                # directory entry
+                continue
+            member = zf.open(info)
+            try:
+                yield (info.filename, member)
+            finally:
+                member.close()
+    finally:
+        zf.close()
+
+def _tar_members(archive):
+    '''
+    archive is a file name, or a file object read as a stream
+    '''
+    if isinstance(archive, basestring):
+        tf = tarfile.open(archive, 'r:*')
+    else:
+        tf = tarfile.open(fileobj=archive, mode='r|*')
+    try:
+        for info in tf:
+            if not info.isfile():
+                continue
+            member = tf.extractfile(info)
+            try:
+                yield (info.name, member)
+            finally:
+                member.close()
+    finally:
+        tf.close()
+
+def is_zip(archive):
+    if isinstance(archive, basestring):
+        return archive.endswith('.zip')
+    try:
+        pos = archive.tell()
+        result = zipfile.is_zipfile(archive)
+        archive.seek(pos)
+    except (AttributeError, IOError):
+        # can't seek, so it can only be a tar stream
+        return False
+    return result
+
+def archive_md5sums(archive, prefix='', ignore_dirs=[], ignore_files=[]):
+    '''
+    {relative path: md5} for each file in a zip or tar archive
+    The md5s are file_hashing.Digests with the sha256 from the same read
+
+    archive: file name or file object (zip file objects must be seekable)
+    prefix: top directory to strip from member names, e.g. 'wordpress/'
+            members outside of it are skipped
+    ignore_dirs, ignore_files: same rules as walking an extracted copy
+    '''
+    ignore_dirs = set(ignore_dirs)
+    ignore_files = set(ignore_files)
+    if is_zip(archive):
+        members = _zip_members(archive)
+    else:
+        members = _tar_members(archive)
+    s = {}
+    for name, member in members:
+        if name.startswith('./'):
+            name = name[2:]
+        if not name.startswith(prefix):
+            continue
+        parts = name.split('/')
+        if ignore_dirs.intersection(parts[:-1]) or parts[-1] in ignore_files:
+            continue
+        s[name[len(prefix):]] = digests_fileobj(member)
+    return s
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+Where an unfinished scan of a site got to, so the next run can go on
+from there
+
+Scans walk directories in sorted order, and every file of a directory is
+checked before the next directory, so the position in a walk is the
+directory being checked plus the names already checked in it. That,
+and the findings so far, are saved now and then during a scan and when
+its time runs out. The next scan of the same site with the same checks
+against the same checksums, addons included, skips everything before
+that position and reports the saved findings along with its own. A
+finished scan removes its checkpoint.
+'''
+
+import hashlib
+import marshal
+import os
+import time
+
+# 2 added the checksums_digest() to the scan
+CHECKPOINT_FORMAT = 2
+# save progress at least this often, in case the scan is killed
+SAVE_SECONDS = 30
+
+def walk_key(rel_dir):
+    '''
+    Sort key for a directory relative to the docroot that puts
+    directories in the order a sorted top-down walk visits them
+    '''
+    if not rel_dir:
+        return []
+    return rel_dir.split('/')
+
+def checksums_digest(checksums):
+    '''
+    md5 of a {path: md5} dict or ReferenceSet, to tell if a scan is
+    checking against the same originals, e.g. with the same addons
+    '''
+    h = hashlib.md5()
+    for path in sorted(checksums):
+        md5 = checksums[path]
+        if isinstance(md5, basestring):
+            md5 = [md5]
+        h.update('%s\0%s\n'% (path, ' '.join(sorted([str(m) for m in md5]))))
+    return h.hexdigest()
+
+class Checkpoint(object):
+    def __init__(self, checkpoint_dir, tw):
+        self.tw = tw
+        self.checkpoint_file = os.path.join(checkpoint_dir, '%s.checkpoint'% (hashlib.md5(tw.docroot).hexdigest(),))
+        # what the scan checks, a checkpoint of a different scan is no use
+        self.scan = (tw.docroot, tw.webapp_name, tw.webapp_version, bool(tw.check_changed_files), bool(tw.check_new_files), checksums_digest(tw.checksums))
+        # walk_key() of the directory being checked, and names checked in it
+        self.cursor = None
+        self.done = set()
+        # [(file, error)] found so far
+        self.findings = []
+        self.saved = time.time()
+
+    def load(self):
+        '''
+        Pick up a checkpoint left by an earlier scan, True if there was one
+        '''
+        try:
+            f = open(self.checkpoint_file, 'rb')
+        except IOError:
+            return False
+        try:
+            data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            data = {}
+        finally:
+            f.close()
+        if not isinstance(data, dict) or data.get('format') != CHECKPOINT_FORMAT or data.get('scan') != self.scan:
+            if self.tw.verbose:
+                print 'Ignoring checkpoint %s of another scan'% (self.checkpoint_file,)
+            return False
+        self.cursor = data['cursor']
+        self.done = set(data['done'])
+        self.findings = data['findings']
+        if self.tw.verbose:
+            print 'Resuming scan of %s from %s'% (self.tw.docroot, '/'.join(self.cursor or []) or 'the top')
+        return True
+
+    def save(self):
+        '''
+        write to a temp file and rename, like ScanCache.save()
+        '''
+        tmp_file = '%s.%d.tmp'% (self.checkpoint_file, os.getpid())
+        f = open(tmp_file, 'wb')
+        try:
+            marshal.dump({'format': CHECKPOINT_FORMAT, 'scan': self.scan, 'cursor': self.cursor,
+                          'done': list(self.done), 'findings': self.findings}, f)
+        finally:
+            f.close()
+        os.rename(tmp_file, self.checkpoint_file)
+        self.saved = time.time()
+
+    def remove(self):
+        try:
+            os.unlink(self.checkpoint_file)
+        except OSError:
+            pass
+
+    def checked(self, abs_path, error=None):
+        '''
+        abs_path has been checked, with error if it is suspect
+        '''
+        rel_dir, name = os.path.split(self.tw.get_relative_path(abs_path))
+        key = walk_key(rel_dir)
+        if key != self.cursor:
+            # the walk has moved on, the last directory is done
+            self.cursor = key
+            self.done = set()
+        self.done.add(name)
+        if error:
+            self.findings.append((abs_path, error))
+        if time.time() - self.saved > SAVE_SECONDS:
+            self.save()
+
+    def skip_dir(self, rel_dir):
+        '''
+        True if the whole tree under rel_dir was checked before
+        '''
+        if self.cursor is None:
+            return False
+        key = walk_key(rel_dir)
+        return key < self.cursor and self.cursor[:len(key)] != key
+
+    def skip_files(self, rel_dir):
+        '''
+        names of rel_dir's files that were checked before, None for all of them
+        '''
+        if self.cursor is None:
+            return set()
+        key = walk_key(rel_dir)
+        if key < self.cursor:
+            return None
+        if key == self.cursor:
+            return self.done
+        return set()
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+'''
+Checksums of original web application files, kept in a SQLite database
+
+Replaces the webapp_checksums.py dict literal - a scan only loads the
+one webapp version it needs instead of importing every version of
+every webapp.
+
+Most versions are stored as a delta against a nearby version stored
+whole: only the files that changed, plus the paths it no longer has.
+So the catalog grows with the number of changed files, and loading a
+version reads at most one whole version and one delta.
+'''
+
+import marshal
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from distutils.version import LooseVersion
+from optparse import OptionParser
+from file_hashing import Digests
+from reference_set import ReferenceSet
+
+DEFAULT_DB = 'webapp_checksums.db'
+# seconds to wait for another process' write to finish
+LOCK_TIMEOUT = 300
+# a version is stored whole if more than this share of its files differ
+# from every base it could be a delta of
+DELTA_LIMIT = 0.5
+# number of nearby whole versions tried as the base of a new one
+MAX_BASES = 4
+# PRAGMA user_version of a catalog with the tables in SCHEMA
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    webapp TEXT NOT NULL,
+    version TEXT NOT NULL,
+    dir_index BLOB,
+    base_id INTEGER,
+    UNIQUE (webapp, version)
+);
+CREATE INDEX IF NOT EXISTS versions_base_id ON versions (base_id);
+CREATE TABLE IF NOT EXISTS files (
+    version_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_version_path ON files (version_id, path);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+CREATE TABLE IF NOT EXISTS removed (
+    version_id INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removed_version_path ON removed (version_id, path);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    webapp TEXT PRIMARY KEY,
+    paths BLOB NOT NULL
+);
+'''
+
+# (user_version, sql) bringing an older catalog up to that version
+MIGRATIONS = [
+    # versions stored as deltas against a base
+    (2, '''
+ALTER TABLE versions ADD COLUMN base_id INTEGER;
+CREATE INDEX IF NOT EXISTS versions_base_id ON versions (base_id);
+DROP INDEX IF EXISTS files_version_id;
+CREATE INDEX IF NOT EXISTS files_version_path ON files (version_id, path);
+'''),
+    # sha256s, rows without one keep working by md5
+    (3, 'ALTER TABLE files ADD COLUMN sha256 TEXT'),
+]
+
+def build_dir_index(checksums):
+    '''
+    Directory trie of the original source tree, as nested dicts of
+    {dir name: {sub dir name: ...}}, plus the set of relative dirs
+    that directly hold original files ('' is the top level)
+    '''
+    trie = {}
+    dirs = set([''])
+    for f in checksums.keys():
+        parts = f.split('/')[:-1]
+        if not parts:
+            continue
+        dirs.add('/'.join(parts))
+        node = trie
+        for d in parts:
+            node = node.setdefault(d, {})
+    return (trie, dirs)
+
+def _digests(md5, sha256):
+    if sha256 is None:
+        return md5
+    return Digests(md5, sha256)
+
+def _add_md5(checksums, path, md5):
+    '''
+    a path with several rows becomes a list of its md5s
+    '''
+    try:
+        known = checksums[path]
+    except KeyError:
+        checksums[path] = md5
+        return
+    if isinstance(known, list):
+        known.append(md5)
+    else:
+        checksums[path] = [known, md5]
+
+class _WriteTransaction(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+        return False
+
+class ChecksumStore(object):
+    '''
+    get(), has() and put() work on one (webapp, version) at a time
+
+    A checksum set is a dict of {relative path: md5}, where md5 is a list
+    for files with several known good versions (see get_wordpress_checksums)
+    An md5 that is a file_hashing.Digests has its sha256 stored with it
+
+    A version with a base_id only has rows in files for the paths that
+    differ from its base, and rows in removed for the base's paths it
+    doesn't have. Bases are always stored whole.
+
+    A long running process can call enable_cache() to keep the most
+    recently used ReferenceSets in memory for every ChecksumStore.
+    Versions put by this process are dropped from it; ones put by
+    another process are not noticed until they fall out of it.
+    '''
+    # (db_file, webapp, version) -> ReferenceSet, see enable_cache()
+    _cache = None
+    _cache_size = 0
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def enable_cache(cls, size):
+        with cls._cache_lock:
+            cls._cache = OrderedDict()
+            cls._cache_size = size
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            if self._cache is None:
+                return None
+            checksums = self._cache.pop(key, None)
+            if checksums is not None:
+                self._cache[key] = checksums
+            return checksums
+
+    def _cache_put(self, key, checksums):
+        with self._cache_lock:
+            if self._cache is None:
+                return
+            self._cache[key] = checksums
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, key):
+        with self._cache_lock:
+            if self._cache is not None:
+                self._cache.pop(key, None)
+
+    def __init__(self, db_file=DEFAULT_DB, verbose=False):
+        self.db_file = db_file
+        self.verbose = verbose
+        # a connection per thread, sqlite3 won't share one between them
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        '''
+        Many scanners may add checksums at once - writers append to the
+        write-ahead log under SQLite's lock and readers never block.
+        isolation_level None so we can take the write lock up front
+        with BEGIN IMMEDIATE (see transaction())
+        Each thread gets its own connection, e.g. scans served by
+        scan_server.py sharing one store
+        '''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.db_file, timeout=LOCK_TIMEOUT, isolation_level=None)
+            # plain str paths, like os.walk() gives us
+            db.text_factory = str
+            if self._schema_version() < SCHEMA_VERSION:
+                self._migrate()
+        return db
+
+    def _schema_version(self):
+        return self.db.execute('PRAGMA user_version').fetchone()[0]
+
+    def _layout_version(self):
+        '''
+        The SCHEMA_VERSION a catalog's tables are at, by their columns -
+        older catalogs don't have user_version set. 0 if there are no
+        tables yet
+        '''
+        versions = [row[1] for row in self.db.execute('PRAGMA table_info(versions)')]
+        files = [row[1] for row in self.db.execute('PRAGMA table_info(files)')]
+        if not versions:
+            return 0
+        if 'sha256' in files:
+            return 3
+        if 'base_id' in versions:
+            return 2
+        return 1
+
+    def _migrate(self):
+        '''
+        Create or update the tables, once per catalog - a catalog that is
+        up to date is only read, so scanners don't queue behind writers
+        '''
+        # persistent, and can't be changed inside a transaction
+        self.db.execute('PRAGMA journal_mode = WAL')
+        with self.transaction():
+            # another process may have got here first
+            if self._schema_version() >= SCHEMA_VERSION:
+                return
+            version = self._layout_version()
+            steps = [step for step_version, step in MIGRATIONS if version and step_version > version]
+            # then any tables and indexes added since without a step
+            for statement in ';'.join(steps + [SCHEMA]).split(';'):
+                if statement.strip():
+                    self.db.execute(statement)
+            self.db.execute('PRAGMA user_version = %d'% (SCHEMA_VERSION,))
+
+    def transaction(self, sql=None):
+        '''
+        Run sql in a write transaction, or return a context manager for one
+        '''
+        if sql:
+            with self.transaction():
+                for statement in sql.split(';'):
+                    if statement.strip():
+                        self.db.execute(statement)
+            return
+        return _WriteTransaction(self.db)
+
+    def close(self):
+        '''
+        close this thread's connection
+        '''
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def get_version_id(self, webapp, version):
+        row = self.db.execute('SELECT id FROM versions WHERE webapp = ? AND version = ?', (webapp, version)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def has(self, webapp, version):
+        return self.get_version_id(webapp, version) is not None
+
+    def get(self, webapp, version):
+        '''
+        {path: md5} for one webapp version, KeyError if we have none
+        '''
+        version_id = self.get_version_id(webapp, version)
+        if version_id is None:
+            raise KeyError((webapp, version))
+        checksums = {}
+        for path, md5, sha256 in self._rows(version_id):
+            _add_md5(checksums, path, _digests(md5, sha256))
+        return checksums
+
+    def get_reference_set(self, webapp, version):
+        '''
+        get() as a compact ReferenceSet, for scanning against
+        It may be shared with other callers (see enable_cache()), so
+        copy it before adding to it
+        '''
+        key = (self.db_file, webapp, version)
+        checksums = self._cache_get(key)
+        if checksums is not None:
+            return checksums
+        version_id = self.get_version_id(webapp, version)
+        if version_id is None:
+            raise KeyError((webapp, version))
+        checksums = ReferenceSet()
+        for path, md5, sha256 in self._rows(version_id):
+            checksums.add(path, _digests(md5, sha256))
+        self._cache_put(key, checksums)
+        return checksums
+
+    def _rows(self, version_id, paths=None):
+        '''
+        (path, md5, sha256) for each file of a version, limited to paths if given -
+        the rows kept from its base first, then its own
+        '''
+        where = ''
+        args = []
+        if paths is not None:
+            paths = list(paths)
+            where = ' AND path IN (%s)'% (', '.join(['?'] * len(paths)),)
+            args = paths
+        base_id = self.db.execute('SELECT base_id FROM versions WHERE id = ?', (version_id,)).fetchone()[0]
+        if base_id is not None:
+            sql = 'SELECT path, md5, sha256 FROM files b WHERE version_id = ?' + where
+            sql += ' AND NOT EXISTS (SELECT 1 FROM files o WHERE o.version_id = ? AND o.path = b.path)'
+            sql += ' AND NOT EXISTS (SELECT 1 FROM removed r WHERE r.version_id = ? AND r.path = b.path)'
+            for row in self.db.execute(sql + ' ORDER BY rowid', [base_id] + args + [version_id, version_id]):
+                yield row
+        for row in self.db.execute('SELECT path, md5, sha256 FROM files WHERE version_id = ?' + where + ' ORDER BY rowid', [version_id] + args):
+            yield row
+
+    def get_versions(self, webapp, paths=None):
+        '''
+        {version: {path: md5}} for every version of a webapp we have,
+        limited to the given paths if any
+        '''
+        checksum_sets = {}
+        for version_id, version in self.db.execute('SELECT id, version FROM versions WHERE webapp = ?', (webapp,)).fetchall():
+            checksums = checksum_sets[version] = {}
+            for path, md5, sha256 in self._rows(version_id, paths):
+                _add_md5(checksums, path, md5)
+        return checksum_sets
+
+    def get_fingerprint(self, webapp):
+        '''
+        paths saved by put_fingerprint(), KeyError if there are none or
+        versions were added since
+        '''
+        row = self.db.execute('SELECT paths FROM fingerprints WHERE webapp = ?', (webapp,)).fetchone()
+        if row is None:
+            raise KeyError(webapp)
+        return marshal.loads(str(row[0]))
+
+    def put_fingerprint(self, webapp, paths):
+        with self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO fingerprints (webapp, paths) VALUES (?, ?)', (webapp, sqlite3.Binary(marshal.dumps(list(paths)))))
+
+    def find_md5(self, md5):
+        '''
+        [(webapp, version, path)] of every original file with this md5
+        md5 may be file_hashing.Digests, originals with a different
+        sha256 don't match
+        '''
+        same_sha256 = ' AND (sha256 IS NULL OR ? IS NULL OR sha256 = ?)'
+        sql = 'SELECT webapp, version, path FROM files JOIN versions ON versions.id = files.version_id WHERE md5 = ?' + same_sha256
+        # versions that kept the file from their base
+        sql += ' UNION ALL SELECT webapp, version, path FROM files b JOIN versions ON versions.base_id = b.version_id WHERE md5 = ?' + same_sha256
+        sql += ' AND NOT EXISTS (SELECT 1 FROM files o WHERE o.version_id = versions.id AND o.path = b.path)'
+        sql += ' AND NOT EXISTS (SELECT 1 FROM removed r WHERE r.version_id = versions.id AND r.path = b.path)'
+        sha256 = getattr(md5, 'sha256', None)
+        md5 = str(md5)
+        return self.db.execute(sql, (md5, sha256, sha256, md5, sha256, sha256)).fetchall()
+
+    def get_dir_index(self, webapp, version):
+        '''
+        build_dir_index() result saved by put(), KeyError if we have none
+        '''
+        row = self.db.execute('SELECT dir_index FROM versions WHERE webapp = ? AND version = ?', (webapp, version)).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError((webapp, version))
+        trie, dirs = marshal.loads(str(row[0]))
+        return (trie, set(dirs))
+
+    def put(self, webapp, version, checksums):
+        '''
+        Add or replace the checksums for one webapp version
+        '''
+        self.put_many(webapp, {version: checksums})
+
+    def put_many(self, webapp, checksum_sets):
+        '''
+        Add or replace {version: checksums} for a webapp in one transaction
+        '''
+        with self.transaction():
+            for version, checksums in sorted(checksum_sets.iteritems()):
+                self._put(webapp, version, checksums)
+
+    def _put(self, webapp, version, checksums, bases=None):
+        '''
+        Store one version, as a delta of whichever of bases (version ids,
+        by default the nearest whole versions) it differs least from.
+        Return the base id, None if it was stored whole.
+        '''
+        trie, dirs = build_dir_index(checksums)
+        dir_index = sqlite3.Binary(marshal.dumps((trie, sorted(dirs))))
+        # {path: ((md5, sha256 or None), ...)}
+        sums = {}
+        for path, md5 in checksums.iteritems():
+            if isinstance(md5, basestring):
+                md5 = [md5]
+            sums[path] = tuple([(str(m), getattr(m, 'sha256', None)) for m in md5])
+        # only this version's rows are touched, whatever else is in the catalog
+        self.db.execute('INSERT OR IGNORE INTO versions (webapp, version) VALUES (?, ?)', (webapp, version))
+        version_id = self.get_version_id(webapp, version)
+        self._expand_dependents(version_id)
+        self.db.execute('DELETE FROM files WHERE version_id = ?', (version_id,))
+        self.db.execute('DELETE FROM removed WHERE version_id = ?', (version_id,))
+        if bases is None:
+            bases = self._nearest_bases(webapp, version, version_id)
+        base_id, changed, removed = self._choose_base(sums, bases)
+        rows = []
+        for path in changed:
+            rows.extend([(path, m, sha256) for m, sha256 in sums[path]])
+        self.db.execute('UPDATE versions SET dir_index = ?, base_id = ? WHERE id = ?', (dir_index, base_id, version_id))
+        self.db.executemany('INSERT INTO files (version_id, path, md5, sha256) VALUES (%d, ?, ?, ?)'% (version_id,), rows)
+        self.db.executemany('INSERT INTO removed (version_id, path) VALUES (%d, ?)'% (version_id,), [(path,) for path in removed])
+        # a new version may need more files to tell it apart
+        self.db.execute('DELETE FROM fingerprints WHERE webapp = ?', (webapp,))
+        self._cache_drop((self.db_file, webapp, version))
+        if self.verbose:
+            if base_id is None:
+                print 'Stored %d checksums for %s version %s in %s'% (len(rows), webapp, version, self.db_file)
+            else:
+                print 'Stored %d checksums for %s version %s in %s, %d changed and %d removed since version id %d'% \
+                    (len(sums), webapp, version, self.db_file, len(changed), len(removed), base_id)
+        return base_id
+
+    def _nearest_bases(self, webapp, version, version_id):
+        '''
+        ids of the MAX_BASES whole versions of webapp closest to version
+        '''
+        rows = self.db.execute('SELECT id, version FROM versions WHERE webapp = ? AND base_id IS NULL AND id != ?', (webapp, version_id)).fetchall()
+        rows.append((None, version))
+        rows.sort(key=lambda row: LooseVersion(row[1]))
+        i = rows.index((None, version))
+        nearest = sorted(range(len(rows)), key=lambda j: abs(j - i))[1:MAX_BASES + 1]
+        return [rows[j][0] for j in nearest]
+
+    def _choose_base(self, sums, bases):
+        '''
+        (base id, changed paths, removed paths) for the smallest delta
+        of {path: ((md5, sha256), ...)} against one of bases, or
+        (None, every path, []) if none are worth it
+        '''
+        best = (None, sums.keys(), [])
+        best_size = len(sums) * DELTA_LIMIT
+        for base_id in bases:
+            base = {}
+            for path, md5, sha256 in self._rows(base_id):
+                base[path] = base.get(path, ()) + ((md5, sha256),)
+            changed = [path for path, md5 in sums.iteritems() if base.get(path) != md5]
+            removed = [path for path in base if path not in sums]
+            if len(changed) + len(removed) < best_size:
+                best = (base_id, changed, removed)
+                best_size = len(changed) + len(removed)
+        return best
+
+    def _expand_dependents(self, version_id):
+        '''
+        Store the versions that are deltas of version_id whole,
+        before version_id is replaced
+        '''
+        for (dependent_id,) in self.db.execute('SELECT id FROM versions WHERE base_id = ?', (version_id,)).fetchall():
+            rows = list(self._rows(dependent_id))
+            self.db.execute('DELETE FROM files WHERE version_id = ?', (dependent_id,))
+            self.db.execute('DELETE FROM removed WHERE version_id = ?', (dependent_id,))
+            self.db.execute('UPDATE versions SET base_id = NULL WHERE id = ?', (dependent_id,))
+            self.db.executemany('INSERT INTO files (version_id, path, md5, sha256) VALUES (%d, ?, ?, ?)'% (dependent_id,), rows)
+
+    def rebase(self):
+        '''
+        Store every version again, oldest first, as a delta of the nearest
+        older whole versions - for catalogs from before deltas, or ones
+        that added versions out of order
+        '''
+        for webapp in self.webapps():
+            with self.transaction():
+                bases = []
+                for version in sorted(self.versions(webapp), key=LooseVersion):
+                    checksums = self.get(webapp, version)
+                    if self._put(webapp, version, checksums, bases[-MAX_BASES:]) is None:
+                        bases.append(self.get_version_id(webapp, version))
+
+    def stats(self):
+        '''
+        [(webapp, versions, versions stored whole, checksum rows stored,
+        checksum rows if every version was stored whole)]
+        '''
+        stats = []
+        for webapp in self.webapps():
+            versions = whole = stored = full = 0
+            for version_id, base_id in self.db.execute('SELECT id, base_id FROM versions WHERE webapp = ?', (webapp,)).fetchall():
+                own = self.db.execute('SELECT COUNT(*) FROM files WHERE version_id = ?', (version_id,)).fetchone()[0]
+                versions += 1
+                stored += own
+                full += own
+                if base_id is None:
+                    whole += 1
+                else:
+                    sql = 'SELECT COUNT(*) FROM files b WHERE version_id = ?'
+                    sql += ' AND NOT EXISTS (SELECT 1 FROM files o WHERE o.version_id = ? AND o.path = b.path)'
+                    sql += ' AND NOT EXISTS (SELECT 1 FROM removed r WHERE r.version_id = ? AND r.path = b.path)'
+                    full += self.db.execute(sql, (base_id, version_id, version_id)).fetchone()[0]
+            stats.append((webapp, versions, whole, stored, full))
+        return stats
+
+    def compact(self):
+        '''
+        Fold the write-ahead log back into the database and reclaim space
+        left by replaced versions. SQLite checkpoints the log on its own
+        as it grows, this is for a nightly cron job.
+        '''
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.db.execute('VACUUM')
+        if self.verbose:
+            print 'Compacted %s to %d bytes'% (self.db_file, os.path.getsize(self.db_file))
+
+    def webapps(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT webapp FROM versions ORDER BY webapp')]
+
+    def versions(self, webapp):
+        return [row[0] for row in self.db.execute('SELECT version FROM versions WHERE webapp = ? ORDER BY version', (webapp,))]
+
+    def import_sums(self, sums):
+        '''
+        Copy a webapp_checksums.py style {webapp: {version: {path: md5}}} dict
+        '''
+        for webapp, versions in sums.iteritems():
+            for version, checksums in versions.iteritems():
+                self.put(webapp, version, checksums)
+
+
+if __name__ == '__main__':
+    usage = '%s [options] import|list|stats|compact [webapp] [version] \n'% (os.path.basename(__file__),)
+    usage += '     %s [options] find md5 \n'% (os.path.basename(__file__),)
+    usage += 'e.g. %s list wordpress-core 4.4.2 \n'% (os.path.basename(__file__),)
+    usage += '''
+import:  copy every checksum from an old webapp_checksums.py into the database
+list:    print the webapps, versions or checksums we have
+find:    print the webapp versions and files an md5 belongs to
+stats:   print how much storing versions as deltas saves
+compact: store every version again as a delta of the best base,
+         checkpoint the write-ahead log and vacuum the database
+    '''
+    parser = OptionParser(usage=usage)
+    parser.add_option("-d", "--db", dest="db_file", type="string", action="store", default=DEFAULT_DB,
+                      help="checksum database (default %s)"% (DEFAULT_DB,))
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      dest="verbose", help="verbose output")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    store = ChecksumStore(options.db_file, verbose=options.verbose)
+    if args[0] == 'import':
+        import webapp_checksums
+        store.import_sums(webapp_checksums.sums)
+    elif args[0] == 'list':
+        if len(args) == 1:
+            for webapp in store.webapps():
+                print webapp
+        elif len(args) == 2:
+            for version in store.versions(args[1]):
+                print version
+        else:
+            for f, md5sum in sorted(store.get(args[1], args[2]).iteritems()):
+                print '%s  %s  %s \t%s'% (args[1], args[2], f, md5sum)
+    elif args[0] == 'find' and len(args) == 2:
+        for webapp, version, f in sorted(store.find_md5(args[1])):
+            print '%s  %s  %s'% (webapp, version, f)
+    elif args[0] in ('stats', 'compact'):
+        if args[0] == 'compact':
+            store.rebase()
+            store.compact()
+        for webapp, versions, whole, stored, full in store.stats():
+            print '%s: %d versions, %d stored whole, %d of %d checksums stored (%d%% saved)'% \
+                (webapp, versions, whole, stored, full, 100 - 100 * stored / max(full, 1))
+        print '%s: %d bytes'% (store.db_file, os.path.getsize(store.db_file))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -1,13 +1,20 @@
 #!/usr/bin/env python2.7
 
 import argparse
+import os
 import sys
+import time
 from optparse import OptionParser
 from os.path import basename, join
-import get_joomla_checksums
-from webapp_tripwire import WebappTripwire
+import get_drupal_checksums
+from fleet import scan_fleet
+import io_governor
+from scan_cache import ScanCache
+from scan_server import request_scan
+from webapp_tripwire import WebappTripwire, print_details, print_finding
+from watch import watch
 
-webapp_name = 'joomla-core'
+webapp_name = 'drupal'
 ignore_dirs = ['language']
 ignore_files = ['configuration.php', 'error.php', 'joomla_update.php']
 ignore_types = ['.ini']
@@ -15,19 +22,14 @@ ignore_types = ['.ini']
 class DrupalTripwire(WebappTripwire):
     def get_checksums(self):
         try:
-            from webapp_checksums import sums # dict of md5sums of original webapp source files 
-            self.checksums = sums[self.webapp_name][self.webapp_version]
+            self.load_checksums()
             return 0
-        except ImportError:
-            if self.verbose:
-                print 'unable to open webapp_checksums.py'
         except KeyError:
             if self.verbose:
                 print 'missing checksum for version %s'% (self.webapp_version,)
         # Download  archive and generate checksums
         get_drupal_checksums.add_checksums(self.webapp_version, verbose=True)
-        from webapp_checksums import sums # dict of md5sums of original webapp source files 
-        self.checksums = sums[self.webapp_name][self.webapp_version]
+        self.load_checksums()
         return 0
 
     def get_webapp_version(self):
@@ -50,19 +52,22 @@ class DrupalTripwire(WebappTripwire):
         except IOError:
 	    # for drupal 8.x
 	    version_file = join(self.docroot, 'core/CHANGELOG.txt')
-            f = open(version_file)
-        except IOError:
-            if self.verbose:
-                print 'Error checking webapp version'
-                print 'Unable to open file %s'% (version_file,)
-            return None
+            try:
+                f = open(version_file)
+            except IOError:
+                if self.verbose:
+                    print 'Error checking webapp version'
+                    print 'Unable to open file %s'% (version_file,)
+                return None
         version  = ''
         for line in f:
-            if not version and line.startswith('Drupal'):
+            if line.startswith('Drupal'):
+                # newest release is at the top
                 version = line.split()[1].strip(',')
+                break
         f.close()
 	# basic sanity check 
-        if version[0] in ['6', '7', '8', '9']:
+        if version and version[0] in ['6', '7', '8', '9']:
             self.webapp_version = version
             if self.verbose:
                 print "Drupal version %s"% (self.webapp_version,)
@@ -75,15 +80,38 @@ class DrupalTripwire(WebappTripwire):
                 print 'Unable to determine %s version from file %s'% (self.webapp_name, version_file,)
         return None
 
-    def scan(self):
+    def scan_iter(self):
         '''
-        Return a dict of {file: error}
+        Yield (file, error) for each suspect file as it is found
         '''
-        if not self.get_webapp_version():
+        if not self.detect_webapp_version():
             # this is not Drupal
-            return {}
+            return
         self.get_checksums()
-        return super(DrupalTripwire, self).scan()
+        for finding in super(DrupalTripwire, self).scan_iter():
+            yield finding
+
+def scan_site(fs_path, options, cache=None, stream=None):
+    '''
+    Do what the command line options say for one path, printing to
+    stream (stdout by default)
+    Return the DrupalTripwire if the path was scanned, else None
+    '''
+    if stream is None:
+        stream = sys.stdout
+    if options.unwhitelist_files:
+        tw = DrupalTripwire(verbose=options.verbose, webapp_name=webapp_name)
+        tw.remove_from_whitelist(fs_path)
+        return None
+    tw = DrupalTripwire(fs_path, ignore_dirs=ignore_dirs, ignore_files=ignore_files, ignore_types=ignore_types, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files, webapp_name=webapp_name, workers=options.jobs, use_threads=options.use_threads, cache=cache, fingerprint=options.fingerprint, io_governor=io_governor.from_options(options), readahead=options.readahead, deadline=options.deadline, checkpoint_dir=options.checkpoint_dir)
+    if not tw.detect_webapp_version():
+        # this is not Drupal
+        return None
+    if options.print_version:
+        print_details(tw, options.json_lines, stream=stream)
+    for f, error in tw.scan_iter():
+        print_finding(tw, f, error, options.json_lines, stream)
+    return tw
 
 
 if __name__ == '__main__':
@@ -102,6 +130,40 @@ if __name__ == '__main__':
                         dest="whitelist_files", help="add files from scan to whitelist")
     parser.add_option("-u", "--unwhitelist-files", action="store_true", default=False,
                         dest="unwhitelist_files", help="remove files on this path from whitelist")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", action="store", default=1,
+                        help="number of hashing worker processes (default 1, no parallelism)")
+    parser.add_option("--threads", action="store_true", default=False,
+                        dest="use_threads", help="use threads instead of processes for hashing workers")
+    parser.add_option("--cache", dest="cache_file", type="string", action="store", default=None,
+                        help="reuse md5s of files unchanged since the last scan, stored in this file")
+    parser.add_option("--rehash-all", action="store_true", default=False,
+                        dest="rehash_all", help="ignore md5s in the --cache file and hash every file again")
+    parser.add_option("--fingerprint", action="store_true", default=False,
+                        dest="fingerprint", help="check the version file against the files themselves, and use the version they match")
+    parser.add_option("--json", action="store_true", default=False,
+                        dest="json_lines", help="print findings as they are found, one JSON object per line")
+    parser.add_option("--watch", action="store_true", default=False,
+                        dest="watch", help="after scanning, keep checking files as they are written (Linux inotify)")
+    parser.add_option("--site-jobs", dest="site_jobs", type="int", action="store", default=1,
+                        help="number of sites to scan at once, each in its own process (default 1)")
+    parser.add_option("--site-timeout", dest="site_timeout", type="int", action="store", default=0,
+                        help="give up on a site after this many seconds (default 0, no limit)")
+    parser.add_option("--max-read-mb", dest="max_read_mb", type="float", action="store", default=0,
+                        help="read at most this many MB/s of files, shared between site owners (default 0, no limit)")
+    parser.add_option("--max-file-rate", dest="max_file_rate", type="float", action="store", default=0,
+                        help="hash at most this many files per second (default 0, no limit)")
+    parser.add_option("--max-load", dest="max_load", type="float", action="store", default=0,
+                        help="slow down while the load average per CPU is over this (default 0, no limit)")
+    parser.add_option("--max-io-pressure", dest="max_io_pressure", type="float", action="store", default=0,
+                        help="slow down while tasks wait on IO more than this %% of the time, from /proc/pressure/io (default 0, no limit)")
+    parser.add_option("--readahead", dest="readahead", type="choice", choices=['inode', 'extent'], action="store", default=None,
+                        help="hash each directory's files in inode or on-disk extent order, reading ahead and dropping them from the page cache afterwards")
+    parser.add_option("--time-budget", dest="time_budget", type="int", action="store", default=0,
+                        help="stop scanning after this many seconds in all (default 0, no limit)")
+    parser.add_option("--checkpoint-dir", dest="checkpoint_dir", type="string", action="store", default=None,
+                        help="save how far unfinished scans got in this directory, and go on from there next time")
+    parser.add_option("--socket", dest="socket_file", type="string", action="store", default=None,
+                        help="have the scan_server.py listening on this Unix socket do the scans")
     parser.add_option("-f", "--from-file", dest="from_file", type="string", action="store",
 		      default=None, help="read file paths from a file (probably a little faster)") 
     # parser.add_option("-e", "--email", dest="email_notify", type="string", action="store") 
@@ -120,16 +182,55 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(1)
 
-    # set() == uniq 
-    for fs_path in sorted(list(set(fs_paths))):
-        if options.unwhitelist_files:
-            tw = DrupalTripwire(verbose=options.verbose, webapp_name=webapp_name)
-            tw.remove_from_whitelist(fs_path)
-        else:
-            tw = DrupalTripwire(fs_path, ignore_dirs=ignore_dirs, ignore_files=ignore_files, ignore_types=ignore_types, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files, webapp_name=webapp_name)
-            joomla_version = tw.get_webapp_version()
-            if options.print_version and tw.get_webapp_version():
-                print tw.get_webapp_details()
-            for f, error in tw.scan().iteritems():
-                print '%s %s'% (error, f)
+    options.deadline = None
+    if options.time_budget:
+        options.deadline = time.time() + options.time_budget
+    if options.checkpoint_dir and not os.path.isdir(options.checkpoint_dir):
+        os.makedirs(options.checkpoint_dir)
+
+    # in JSON mode stdout is only findings, anything else we print is
+    # for people and goes to stderr
+    findings_out = sys.stdout
+    if options.json_lines:
+        sys.stdout = sys.stderr
+
+    if options.socket_file:
+        if options.watch:
+            print "--watch can't be used with --socket"
+            sys.exit(1)
+        for fs_path in sorted(list(set(fs_paths))):
+            request_scan(options.socket_file, 'drupal', fs_path, options, findings_out)
+        sys.exit(0)
 
+    cache = None
+    if options.cache_file:
+        cache = ScanCache(options.cache_file, rehash_all=options.rehash_all, verbose=options.verbose)
+        cache.load()
+
+    # scanned sites, kept for --watch
+    watched = []
+    # whitelist changes are made one site at a time in this process,
+    # separate processes would each write back their own copy of it
+    if (options.site_jobs > 1 or options.site_timeout) and not (options.whitelist_files or options.unwhitelist_files):
+        if options.watch:
+            print "--watch can't be used with --site-jobs or --site-timeout"
+            sys.exit(1)
+        # the read budgets are for the whole run, split between the processes
+        options.max_read_mb /= max(options.site_jobs, 1)
+        options.max_file_rate /= max(options.site_jobs, 1)
+        scan_fleet(scan_site, sorted(list(set(fs_paths))), options, cache, options.site_jobs, options.site_timeout, findings_out)
+    else:
+        # set() == uniq 
+        for fs_path in sorted(list(set(fs_paths))):
+            tw = scan_site(fs_path, options, cache, findings_out)
+            if options.watch and tw:
+                watched.append(tw)
+    if cache:
+        cache.save()
+    if options.watch and watched:
+        try:
+            watch(watched, options.json_lines, options.verbose, findings_out)
+        except KeyboardInterrupt:
+            pass
+        if cache:
+            cache.save()
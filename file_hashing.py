@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+Bounded memory md5 hashing shared by the tripwires and checksum generators
+
+Files are read in fixed size chunks into a buffer that is reused for
+every file hashed by the same thread, so memory use does not depend on
+file size.  Very large files are hashed through mmap instead.
+
+The digests_*() functions feed each chunk to sha256 as well, so both
+digests cost a single read.
+'''
+
+import hashlib
+import io
+import mmap
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+# files at least this big are mapped instead of read()
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_local = threading.local()
+
+def _get_buffer():
+    '''
+    one read buffer per thread, allocated on first use
+    '''
+    try:
+        return _local.buffer
+    except AttributeError:
+        _local.buffer = memoryview(bytearray(CHUNK_SIZE))
+        return _local.buffer
+
+class Digests(str):
+    '''
+    An md5 hexdigest that also carries the sha256 hexdigest of the same
+    data, None if it wasn't computed. It compares, hashes and prints as
+    the md5, so code that only knows md5s keeps working.
+    '''
+    def __new__(cls, md5, sha256=None):
+        digests = str.__new__(cls, md5)
+        digests.sha256 = sha256
+        return digests
+
+    def __reduce__(self):
+        return (Digests, (str(self), self.sha256))
+
+def _hash_fileobj(f, hashes):
+    '''
+    feed everything left to read in an open file object to each of hashes
+    '''
+    readinto = getattr(f, 'readinto', None)
+    if readinto:
+        buf = _get_buffer()
+        while True:
+            n = readinto(buf)
+            if not n:
+                break
+            for h in hashes:
+                h.update(buf[:n])
+    else:
+        # e.g. tarfile/zipfile members
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            for h in hashes:
+                h.update(data)
+
+def _hash_mmap(f, size, hashes):
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for offset in xrange(0, size, CHUNK_SIZE):
+            for h in hashes:
+                h.update(buffer(mm, offset, CHUNK_SIZE))
+    finally:
+        mm.close()
+
+def _hash_file(path, hashes):
+    '''
+    raises IOError if the file cannot be read
+    '''
+    f = io.open(path, 'rb', buffering=0)
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            # fresh copies, in case we have to start over
+            mapped = [h.copy() for h in hashes]
+            try:
+                _hash_mmap(f, size, mapped)
+                hashes[:] = mapped
+                return
+            except (EnvironmentError, ValueError):
+                # file shrank, or a filesystem that can't mmap
+                f.seek(0)
+        _hash_fileobj(f, hashes)
+    finally:
+        f.close()
+
+def _digests(hashes):
+    if len(hashes) == 1:
+        return Digests(hashes[0].hexdigest())
+    return Digests(hashes[0].hexdigest(), hashes[1].hexdigest())
+
+def md5_fileobj(f):
+    '''
+    md5 of everything left to read in an open file object
+    '''
+    h = hashlib.md5()
+    _hash_fileobj(f, [h])
+    return h.hexdigest()
+
+def md5_file(path):
+    '''
+    md5 hexdigest of a file - raises IOError if it cannot be read
+    '''
+    hashes = [hashlib.md5()]
+    _hash_file(path, hashes)
+    return hashes[0].hexdigest()
+
+def digests_fileobj(f, sha256=True):
+    '''
+    Digests of everything left to read in an open file object, with
+    the sha256 too unless sha256 is False
+    '''
+    hashes = [hashlib.md5()]
+    if sha256:
+        hashes.append(hashlib.sha256())
+    _hash_fileobj(f, hashes)
+    return _digests(hashes)
+
+def digests_file(path, sha256=True):
+    '''
+    digests_fileobj() of a file - raises IOError if it cannot be read
+    '''
+    hashes = [hashlib.md5()]
+    if sha256:
+        hashes.append(hashlib.sha256())
+    _hash_file(path, hashes)
+    return _digests(hashes)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+'''
+Guess a webapp's version from the files themselves
+
+A handful of files is enough to tell every known version of a webapp
+apart. Those files are picked once per webapp from the checksum store,
+then a site only needs those few files hashed - each version gets a vote
+for every one of them that matches its original, and the most votes win.
+
+Unlike a version file, one missing or edited file can't hide the version.
+'''
+
+import os
+import sys
+from distutils.version import LooseVersion
+from optparse import OptionParser
+from checksum_store import ChecksumStore
+from file_hashing import md5_file
+
+# enough to split hundreds of versions several times over
+MAX_FILES = 48
+# every two versions differ in at least this many of the chosen files,
+# so a few edited or missing files can't swing the vote
+REDUNDANCY = 3
+# a version needs votes from at least this share of the files to count
+MIN_SHARE = 0.5
+
+def _md5_key(md5):
+    if isinstance(md5, list):
+        return frozenset(md5)
+    return md5
+
+def _choose_splitting_files(checksum_sets, present, max_files):
+    '''
+    Greedily pick paths until {version: {path: md5}} are all told apart.
+    Each round takes the path whose md5s split the groups of versions
+    still alike into the most groups. Ties go to the path found in the
+    most versions. Chosen paths are removed from present.
+    '''
+    groups = [sorted(checksum_sets)]
+    chosen = []
+    while groups and len(chosen) < max_files:
+        best = None
+        for path in sorted(present):
+            splits = 0
+            for group in groups:
+                splits += len(set([_md5_key(checksum_sets[v].get(path)) for v in group]))
+            rank = (splits, present[path])
+            if best is None or rank > best[0]:
+                best = (rank, path)
+        if best is None or best[0][0] == len(groups):
+            # nothing left tells the remaining versions apart
+            break
+        path = best[1]
+        chosen.append(path)
+        del present[path]
+        new_groups = []
+        for group in groups:
+            split = {}
+            for v in group:
+                split.setdefault(_md5_key(checksum_sets[v].get(path)), []).append(v)
+            new_groups.extend([g for g in split.itervalues() if len(g) > 1])
+        groups = new_groups
+    return chosen
+
+def choose_files(checksum_sets, max_files=MAX_FILES, redundancy=REDUNDANCY):
+    '''
+    Fingerprint paths for {version: {path: md5}} - redundancy disjoint
+    sets of paths that each tell every version apart on their own
+    '''
+    if len(checksum_sets) < 2:
+        return []
+    present = {}
+    for checksums in checksum_sets.itervalues():
+        for path in checksums:
+            present[path] = present.get(path, 0) + 1
+    chosen = []
+    for i in xrange(redundancy):
+        paths = _choose_splitting_files(checksum_sets, present, max_files - len(chosen))
+        if not paths:
+            break
+        chosen.extend(paths)
+    return chosen
+
+def get_files(store, webapp, verbose=False):
+    '''
+    fingerprint paths for a webapp, chosen and saved in the store on first use
+    '''
+    try:
+        return store.get_fingerprint(webapp)
+    except KeyError:
+        pass
+    paths = choose_files(store.get_versions(webapp))
+    if verbose:
+        print 'Fingerprinting %s with %d files'% (webapp, len(paths))
+    store.put_fingerprint(webapp, paths)
+    return paths
+
+def vote(store, webapp, docroot, verbose=False):
+    '''
+    (votes, [versions]) for the versions whose original files match the
+    most fingerprint files under docroot, newest last
+    ([] if no version gets enough votes to be believed)
+    '''
+    paths = get_files(store, webapp, verbose)
+    if not paths:
+        return (0, [])
+    current = {}
+    for path in paths:
+        try:
+            current[path] = md5_file(os.path.join(docroot, path))
+        except EnvironmentError:
+            pass
+    if not current:
+        return (0, [])
+    votes = {}
+    for version, checksums in store.get_versions(webapp, current.keys()).iteritems():
+        n = 0
+        for path, md5 in checksums.iteritems():
+            if current[path] == md5 or (isinstance(md5, list) and current[path] in md5):
+                n += 1
+        votes[version] = n
+    if not votes:
+        return (0, [])
+    top = max(votes.itervalues())
+    if top < len(paths) * MIN_SHARE:
+        return (top, [])
+    return (top, sorted([v for v, n in votes.iteritems() if n == top], key=LooseVersion))
+
+
+if __name__ == '__main__':
+    usage = '%s [options] webapp path [path path] \n'% (os.path.basename(__file__),)
+    usage += 'e.g. %s wordpress-core /users/bubba/public_html/bubba.com \n'% (os.path.basename(__file__),)
+    usage += '''
+Print the versions of webapp that the files under each path match
+    '''
+    parser = OptionParser(usage=usage)
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      dest="verbose", help="verbose output")
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.print_help()
+        sys.exit(1)
+    store = ChecksumStore()
+    webapp = args[0]
+    if options.verbose:
+        print '%s fingerprint files: %s'% (webapp, ', '.join(get_files(store, webapp, True)))
+    for docroot in args[1:]:
+        votes, versions = vote(store, webapp, docroot, options.verbose)
+        print '%s: %s (%d votes)'% (docroot, ' '.join(versions) or 'no match', votes)
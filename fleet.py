@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''
+Scan many sites at once, each in its own process
+
+Used by the *_tripwire.py scripts for --site-jobs and --site-timeout.
+Sites start largest first, so a big one doesn't start last and finish
+long after the rest. Each site's output is collected and printed in path
+order as soon as every site before it is done, so the report reads the
+same as a one at a time run. A site that runs past the timeout is killed,
+with any hashing workers of its own, and reported as timed out.
+'''
+
+import marshal
+import os
+import signal
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from StringIO import StringIO
+from multiprocessing import Process
+from webapp_tripwire import print_site_error
+
+# seconds between checks on running sites
+POLL_SECONDS = 0.1
+
+def count_cached(cache, fs_paths):
+    '''
+    {fs_path: number of scan cache entries under it}, from one sort of
+    the cache rather than a pass over it per site
+    '''
+    paths = sorted(cache.entries)
+    counts = {}
+    for fs_path in fs_paths:
+        prefix = fs_path.rstrip('/') + '/'
+        # '0' sorts right after '/', so this is the end of the prefix
+        counts[fs_path] = bisect_left(paths, prefix[:-1] + '0') - bisect_left(paths, prefix)
+    return counts
+
+def estimate_size(fs_path, cached=0):
+    '''
+    Rough number of files under fs_path - cached, its count from
+    count_cached(), if it has any, else the entries in its top two
+    directory levels
+    '''
+    if cached:
+        return cached
+    n = 0
+    try:
+        entries = os.listdir(fs_path)
+    except OSError:
+        return 0
+    for entry in entries:
+        n += 1
+        try:
+            n += len(os.listdir(os.path.join(fs_path, entry)))
+        except OSError:
+            pass
+    return n
+
+def _scan_one(scan_site, fs_path, options, cache, out, cache_out):
+    '''
+    Runs in the child process. The scan's findings go to out, and
+    so does everything else it prints unless out is JSON. The cache
+    entries it adds go to cache_out.
+    '''
+    # own process group, so a timeout kills our hashing workers too
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if not options.json_lines:
+        sys.stdout = out
+    try:
+        scan_site(fs_path, options, cache, out)
+    except Exception as e:
+        print_site_error(fs_path, 'Scan failed: %s'% (e,), options.json_lines, out)
+    out.flush()
+    if cache:
+        marshal.dump(cache.changed, cache_out)
+        cache_out.flush()
+
+class _Site(object):
+    def __init__(self, fs_path):
+        self.fs_path = fs_path
+        self.out = None
+        self.cache_out = None
+        self.process = None
+        self.started = None
+        self.finished = None
+        self.timed_out = False
+
+    def start(self, scan_site, options, cache):
+        # opened now rather than for every site up front, a long list
+        # of sites would run out of file descriptors
+        self.out = tempfile.TemporaryFile()
+        self.cache_out = tempfile.TemporaryFile()
+        self.process = Process(target=_scan_one, args=(scan_site, self.fs_path, options, cache, self.out, self.cache_out))
+        self.process.start()
+        self.started = time.time()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # not in its own group yet, or already gone
+            self.process.terminate()
+        self.process.join()
+
+    def report(self, json_lines=False):
+        self.out.seek(0)
+        report = self.out.read()
+        self.out.close()
+        if report and not report.endswith('\n'):
+            report += '\n'
+        error = None
+        if self.timed_out:
+            error = 'Scan timed out after %d seconds'% (self.finished - self.started,)
+        elif self.process.exitcode:
+            error = 'Scan failed with exit code %d'% (self.process.exitcode,)
+        if error:
+            # shaped like the site's findings, JSON or not
+            out = StringIO()
+            print_site_error(self.fs_path, error, json_lines, out)
+            report += out.getvalue()
+        return report
+
+    def cache_entries(self):
+        self.cache_out.seek(0)
+        try:
+            entries = marshal.load(self.cache_out)
+        except (EOFError, ValueError, TypeError):
+            entries = {}
+        self.cache_out.close()
+        return entries
+
+def scan_fleet(scan_site, fs_paths, options, cache=None, jobs=2, timeout=None, stream=None):
+    '''
+    scan_site(fs_path, options, cache, stream) for each of fs_paths, up to
+    jobs at a time, killing any that run longer than timeout seconds.
+    Output goes to stream (stdout by default) in fs_paths order. The cache
+    gets the entries from every site that finished.
+    '''
+    if stream is None:
+        stream = sys.stdout
+    sites = [_Site(fs_path) for fs_path in fs_paths]
+    cached = {}
+    if cache and cache.entries:
+        cached = count_cached(cache, fs_paths)
+    sizes = dict([(fs_path, estimate_size(fs_path, cached.get(fs_path, 0))) for fs_path in fs_paths])
+    waiting = sorted(sites, key=lambda s: sizes[s.fs_path], reverse=True)
+    if options.verbose:
+        # not a finding, stdout is stderr when stream is JSON
+        print 'Scanning %d sites, %d at a time, largest first'% (len(sites), jobs)
+        sys.stdout.flush()
+    running = []
+    # sites[:reported] have been printed
+    reported = 0
+    try:
+        while reported < len(sites):
+            while waiting and len(running) < jobs:
+                site = waiting.pop(0)
+                site.start(scan_site, options, cache)
+                running.append(site)
+            time.sleep(POLL_SECONDS)
+            now = time.time()
+            for site in running[:]:
+                if site.process.is_alive():
+                    if not timeout or now - site.started < timeout:
+                        continue
+                    site.timed_out = True
+                    site.kill()
+                else:
+                    site.process.join()
+                site.finished = now
+                running.remove(site)
+                if cache:
+                    cache.merge(site.cache_entries())
+            while reported < len(sites) and sites[reported].finished:
+                stream.write(sites[reported].report(options.json_lines))
+                stream.flush()
+                reported += 1
+    finally:
+        for site in running:
+            site.kill()
@@ -1,19 +1,14 @@
 #!/usr/bin/env python
 
-import hashlib
 import json
 import os
 import re
 import sys
-import urllib2
 import joomla_download_urls
-from subprocess import call
+from checksum_store import ChecksumStore
+from archive_checksums import archive_md5sums, download_archive
 from optparse import OptionParser
-try:
-    import webapp_checksums 
-    sums = webapp_checksums.sums
-except ImportError:
-    sums = {}
+store = ChecksumStore()
 
 ignore_dirs = ['.git', '.svn']
 ignore_files = ['htaccess.txt',]
@@ -21,20 +16,8 @@ webapp_name = 'drupal'
 
 def get_download_urls(version=False):
     download_files = {}
-    try:
-        archived_versions = [k for k in sums[webapp_name].keys()]
-    except KeyError:
-        sums[webapp_name] = {}
-        archived_versions = sums
     if version:
         url = 'https://ftp.drupal.org/files/projects/drupal-%s.tar.gz'% (version,)
-        try:
-            handler = urllib2.urlopen( urllib2.Request(url) )
-        except urllib2.HTTPError:
-            print "Unable to download %s version %s"% (webapp_name, version,)
-            sys.exit()
-        if not handler.getcode() == 200:
-            raise Exception('error retrieving ' + url)
         download_files = {version: url} 
     else:
         print "Specify which version of %s you need"% (webapp_name,)
@@ -49,45 +32,32 @@ def add_checksums(versions=None, keep_files=False, verbose=True):
     '''
     urls = get_download_urls(versions)
     for version, url in urls.iteritems():
-        archive_file = url.split('/')[-1]
-        # don't allow wget to pick file name
-        assert call(['wget', '-q', url, '-O', archive_file]) == 0
-        update()  
+        keep_file = None
+        if keep_files:
+            keep_file = url.split('/')[-1]
+        archive = download_archive(url, keep_file)
+        if not archive:
+            print "Unable to download %s version %s"% (webapp_name, version,)
+            sys.exit()
         try:
-            # reload webapp_checksums.py if we just updated it
-            reload(webapp_checksums)
-        except NameError:
-            # or initial import if file did not exist previously
-            import webapp_checksums
-        sums = webapp_checksums.sums
-        if not keep_files:
-            assert call(['rm', archive_file]) == 0
+            store.put(webapp_name, version, get_md5sums(archive, 'drupal-%s/'% (version,)))
+        finally:
+            archive.close()
         if verbose: 
-            print 'Added md5 checksums for %s version %s to update_webapp_checksums.py'% (webapp_name, version,)
+            print 'Added md5 checksums for %s version %s to %s'% (webapp_name, version, store.db_file)
 
 def listdir_fullpath(d):
     for (dirpath, dirnames, filenames) in os.walk(d):
         pass
     return [os.path.join(d, f) for f in os.listdir(d)] 
 
-def get_md5sums(directory):
-    strip_chars = len(directory) + 1
+def get_md5sums(archive, prefix=''):
+    '''
+    md5 checksums of the files in a tarball, without extracting it
+    '''
     s = {}
     backward_compat_sums = { }
-
-    for root, dirs, files in os.walk(directory):
-        for d in root.split(os.sep):
-            if d in ignore_dirs:
-                files = ()
-        for f in files:
-            if f in ignore_files:
-                continue
-            aps_path = (os.path.join(root, f))
-            file_to_check = open(aps_path) 
-            data = file_to_check.read()    
-            file_to_check.close() 
-            md5_returned = hashlib.md5(data).hexdigest()
-            s[aps_path[strip_chars:]] = md5_returned
+    s.update(archive_md5sums(archive, prefix, ignore_dirs, ignore_files))
     for f, checksum in backward_compat_sums.iteritems():
         try:
             s[f]
@@ -103,30 +73,9 @@ def update():
     archives = [a for a in (listdir_fullpath('.')) if re.search(archive_re, a)]
     for archive in archives:
         version =  re.search(archive_re, archive).group(1)
-        tmp_dir = 'drupal-%s'% (version,)  
-        archive_type =  re.search(archive_re, archive).group(2)
-        if archive_type.startswith('tar.'):
-            unpack = ['tar', 'xf', archive]
-        else:
-            raise Exception('This should not happen')
-        assert call(unpack) == 0
-        sums.setdefault(webapp_name, {})
-        sums[webapp_name][version] = {}
-        sums[webapp_name][version] = get_md5sums(tmp_dir)
-        assert call(['rm', '-rf', tmp_dir]) == 0
-
-    f = open('webapp_checksums.py', 'w')
-    f.write('sums = %s'% (sums,))
-    # pretty printing options for the file
-    f.write(""" 
-if __name__ == '__main__':
-    for webapp in sums.keys():
-        print webapp
-        for version in sums[webapp].keys():
-            print version
-            for f, md5sum in sums[webapp][version].iteritems():
-                print '%s  %s  %s \t%s'% (webapp, version, f, md5sum)
-    """)
+        # drupal-x.y/ is the top directory in the tarball
+        prefix = 'drupal-%s/'% (version,)  
+        store.put(webapp_name, version, get_md5sums(archive, prefix))
 
 
 if __name__ == '__main__':
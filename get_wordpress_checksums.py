@@ -1,18 +1,15 @@
 #!/usr/bin/env python
 
-import hashlib
 import json
 import os
 import re
 import sys
 import urllib2
-from subprocess import call
+from multiprocessing.pool import ThreadPool
+from checksum_store import ChecksumStore
+from archive_checksums import archive_md5sums, download_archive
 from optparse import OptionParser
-try:
-    import webapp_checksums 
-    sums = webapp_checksums.sums
-except (AttributeError, ImportError):
-    sums = {}
+store = ChecksumStore()
 
 # ignore_dirs = ['.git', '.svn', 'wp-content']
 # WP comes with preinstalled themes and plugins but we need to let plugins/themes scanners check those
@@ -30,6 +27,35 @@ def get_wp_api_versions():
         raise Exception('error retrieving ' + wp_url)
     version_data_json = handler.read()
     return json.JSONDecoder().decode(version_data_json)['offers']
+
+def get_wp_release_versions():
+    '''
+    Every WP release api.wordpress.org knows about
+    '''
+    wp_url = 'https://api.wordpress.org/core/stable-check/1.0/'
+    handler = urllib2.urlopen( urllib2.Request(wp_url) )
+    if not handler.getcode() == 200:
+        raise Exception('error retrieving ' + wp_url)
+    return json.JSONDecoder().decode(handler.read()).keys()
+
+def version_key(version):
+    '''
+    '4.10.1' -> (4, 10, 1) so versions sort and compare numerically
+    '''
+    return tuple([int(x) for x in re.findall(r'[0-9]+', version)])
+
+def get_versions_in_range(first=None, last=None):
+    '''
+    Released versions from first to last, inclusive
+    '''
+    versions = []
+    for version in get_wp_release_versions():
+        if first and version_key(version) < version_key(first):
+            continue
+        if last and version_key(version) > version_key(last):
+            continue
+        versions.append(version)
+    return sorted(versions, key=version_key)
   
 def get_download_urls(version=False):
     '''
@@ -37,22 +63,10 @@ def get_download_urls(version=False):
     the few most current releases via api.wordpress.org
     '''
     download_files = {}
-    try:
-        archived_versions = [k for k in sums[webapp_name].keys()]
-    except KeyError:
-        sums[webapp_name] = {}
-        archived_versions = sums
+    archived_versions = store.versions(webapp_name)
     if version:
         # get requested version
         url = 'https://downloads.wordpress.org/release/wordpress-%s.zip'% (version,)
-        # sanity check should they change this URL
-        try:
-            handler = urllib2.urlopen( urllib2.Request(url) )
-        except urllib2.HTTPError:
-            print 'Unable to open URL ' + url
-            sys.exit()
-        if not handler.getcode() == 200:
-            raise Exception('error retrieving ' + url)
         download_files = {version: url} 
     else:
         # get list of recent releases
@@ -70,29 +84,98 @@ def add_checksums(versions=None, keep_files=False, verbose=True):
     '''
     urls = get_download_urls(versions)
     for version, url in urls.iteritems():
-        archive_file = url.split('/')[-1]
-        # don't allow wget to pick file name
-        assert call(['wget', '-q', url, '-O', archive_file]) == 0
-        update()  
-        try:
-            # reload webapp_checksums.py if we just updated it
-            reload(webapp_checksums)
-        except NameError:
-            # or initial import if file did not exist previously
-            import webapp_checksums
-        sums = webapp_checksums.sums
-        if not keep_files:
-            assert call(['rm', archive_file]) == 0
+        # sanity check should they change this URL
+        version, s = fetch_md5sums((version, url, keep_files))
+        if s is None:
+            print 'Unable to open URL ' + url
+            sys.exit()
+        store.put(webapp_name, version, s)
         if verbose: 
-            print 'Added md5 checksums for %s version %s to webapp_checksums.py'% (webapp_name, version,)
+            print 'Added md5 checksums for %s version %s to %s'% (webapp_name, version, store.db_file)
+
+def fetch_md5sums(job):
+    '''
+    Worker for backfill() - job is (version, url, keep_files)
+    returns (version, md5sums), md5sums is None if url can't be downloaded
+    '''
+    version, url, keep_files = job
+    keep_file = None
+    if keep_files:
+        keep_file = url.split('/')[-1]
+    archive = download_archive(url, keep_file)
+    if not archive:
+        return (version, None)
+    try:
+        return (version, get_md5sums(archive))
+    finally:
+        archive.close()
+
+def backfill_md5sums(job):
+    '''
+    Worker for backfill() - fetch_md5sums(), but a version that fails
+    doesn't stop the others
+    returns (version, md5sums, error), md5sums is None if there is an error
+    '''
+    version, url, keep_files = job
+    try:
+        version, s = fetch_md5sums(job)
+    except Exception as e:
+        return (version, None, '%s: %s'% (url, e))
+    if s is None:
+        return (version, None, 'Unable to open URL ' + url)
+    return (version, s, None)
+
+def backfill(versions, workers=8, keep_files=False, verbose=True):
+    '''
+    Download and hash many versions at once, then store them in one batch
+    Versions we already have are skipped, versions that fail are reported
+    and the rest are stored anyway, even if the backfill is interrupted
+    '''
+    archived_versions = set(store.versions(webapp_name))
+    jobs = []
+    for version in sorted(set(versions), key=version_key):
+        if version in archived_versions:
+            if verbose:
+                print 'Already have md5 checksums for %s version %s'% (webapp_name, version)
+            continue
+        jobs += [(version, get_download_urls(version)[version], keep_files)]
+    if not jobs:
+        return 0
+    checksum_sets = {}
+    failed = []
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        for version, s, error in pool.imap_unordered(backfill_md5sums, jobs):
+            if s is None:
+                print 'Unable to add %s version %s - %s'% (webapp_name, version, error)
+                failed.append(version)
+                continue
+            checksum_sets[version] = s
+            if verbose:
+                print 'Hashed %s version %s'% (webapp_name, version)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        # keep what was hashed
+        store.put_many(webapp_name, checksum_sets)
+        if verbose:
+            print 'Added md5 checksums for %d %s versions to %s'% (len(checksum_sets), webapp_name, store.db_file)
+    if failed:
+        print 'Failed to add %d %s versions: %s'% (len(failed), webapp_name, ' '.join(sorted(failed, key=version_key)))
+    return len(checksum_sets)
 
 def listdir_fullpath(d):
     for (dirpath, dirnames, filenames) in os.walk(d):
         pass
     return [os.path.join(d, f) for f in os.listdir(d)] 
 
-def get_md5sums(directory):
-    strip_chars = len(directory) + 1
+def get_md5sums(archive, prefix='wordpress/'):
+    '''
+    md5 checksums of the files in a WP zip or tarball, without extracting it
+    '''
     s = {}
     # these are lingering on quite a few sites
     comment = '# files lingering from old WP versions #'
@@ -141,19 +224,7 @@ def get_md5sums(directory):
 	'index.php':  empty_file_sums + ['96137494913a1f730a592e8932af394e']
     }
 
-    for root, dirs, files in os.walk(directory):
-        for d in root.split(os.sep):
-            if d in ignore_dirs:
-                files = ()
-        for f in files:
-            if f in ignore_files:
-                continue
-            aps_path = (os.path.join(root, f))
-            file_to_check = open(aps_path) 
-            data = file_to_check.read()    
-            file_to_check.close() 
-            md5_returned = hashlib.md5(data).hexdigest()
-            s[aps_path[strip_chars:]] = md5_returned
+    s.update(archive_md5sums(archive, prefix, ignore_dirs, ignore_files))
     for f, checksum in backward_compat_sums.iteritems():
         try:
             s[f] = backward_compat_sums[f] + [s[f]]
@@ -168,33 +239,8 @@ def update():
     wp_archive = re.compile( r'wordpress-([0-9RC.-]+)\.(tar\.gz|zip)$')
     wps = [w for w in (listdir_fullpath('.')) if re.search(wp_archive, w)]
     for wp in wps:
-        call(['rm', '-rf', 'wordpress']) == 0
         wp_version =  re.search(wp_archive, wp).group(1)
-        archive_type =  re.search(wp_archive, wp).group(2)
-        if archive_type == 'tar.gz':
-            unpack = ['tar', 'xf', wp]
-        elif archive_type == 'zip':
-            unpack = ['unzip', '-qq',  wp]
-        else:
-            raise Exception('This should not happen')
-        assert call(unpack) == 0
-        sums.setdefault(webapp_name, {})
-        sums[webapp_name][wp_version] = {}
-        sums[webapp_name][wp_version] = get_md5sums('wordpress')
-        assert call(['rm', '-rf', 'wordpress']) == 0
-
-    f = open('webapp_checksums.py', 'w')
-    f.write('sums = %s'% (sums,))
-    # pretty printing options for the file
-    f.write(""" 
-if __name__ == '__main__':
-    for webapp in sums.keys():
-        print webapp
-        for version in sums[webapp].keys():
-            print version
-            for f, md5sum in sums[webapp][version].iteritems():
-                print '%s  %s  %s \t%s'% (webapp, version, f, md5sum)
-    """)
+        store.put(webapp_name, wp_version, get_md5sums(wp))
 
 
 if __name__ == '__main__':
@@ -206,14 +252,26 @@ to be used by our webapp integrity checker.
 
 With no arguments, just fetch the most current few versions available.
 
-Or specify specific versions needed.
+Or specify specific versions needed, or a range of releases to backfill
+with --from-version/--to-version, fetched --jobs at a time.
     '''
     parser = OptionParser()
     parser = OptionParser(usage=usage)
     parser.add_option("-k", "--keep-files", dest="keep_files", action="store_true", default=False,
                       help="Keep WP archive files - default is to remove them after use")
+    parser.add_option("--from-version", dest="from_version", type="string", action="store", default=None,
+                      help="backfill every release starting with this version")
+    parser.add_option("--to-version", dest="to_version", type="string", action="store", default=None,
+                      help="backfill every release up to and including this version")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", action="store", default=8,
+                      help="number of versions to download and hash at once (default 8)")
     (options, args) = parser.parse_args()
-    if len(args):
+    if options.from_version or options.to_version:
+        versions = get_versions_in_range(options.from_version, options.to_version) + args
+        backfill(versions, options.jobs, options.keep_files)
+    elif len(args) > 1:
+        backfill(args, options.jobs, options.keep_files)
+    elif len(args):
         for version in args:
             add_checksums(version, options.keep_files)
     else:
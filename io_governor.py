@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''
+Keep scans from hurting the web server they run on
+
+Reads are held to a bytes per second and files per second budget, shared
+fairly between the users whose sites are being scanned at the same time,
+so one huge site can't take it all. When the load average or Linux IO
+pressure (/proc/pressure/io) goes over its limit, the number of files
+hashed at once is halved every second, down to one at a time and then
+short pauses, and goes back up the same way once things are quiet.
+
+One governor is shared by every scan in a process with the same limits,
+see from_options().
+'''
+
+import multiprocessing
+import threading
+import time
+
+# a bucket holds up to this many seconds of its rate, for bursts
+BURST_SECONDS = 1.0
+# a user with no reads for this long no longer takes a share
+IDLE_SECONDS = 5.0
+# how often the load average and IO pressure are read
+CHECK_SECONDS = 1.0
+# each check over a limit halves the workers allowed, down to 1/2**MAX_LEVEL
+MAX_LEVEL = 6
+# from this level on fewer workers alone aren't helping, pause before
+# every file too
+PAUSE_LEVEL = 3
+PAUSE_SECONDS = 0.5
+
+def read_load():
+    '''
+    1 minute load average per CPU, None where there is no /proc/loadavg
+    '''
+    try:
+        f = open('/proc/loadavg')
+        try:
+            load = float(f.read().split()[0])
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return load / cpus
+
+def read_io_pressure():
+    '''
+    % of the last 10 seconds some task was waiting on IO, from the
+    "some avg10=" line of /proc/pressure/io (Linux 4.20+), else None
+    '''
+    try:
+        f = open('/proc/pressure/io')
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0] == 'some':
+            for field in fields[1:]:
+                if field.startswith('avg10='):
+                    try:
+                        return float(field[len('avg10='):])
+                    except ValueError:
+                        return None
+    return None
+
+class _Bucket(object):
+    def __init__(self, now):
+        self.tokens = 0.0
+        self.updated = now
+        self.used = now
+
+    def take(self, amount, rate, now):
+        '''
+        Refill at rate, take amount, and return the seconds to wait
+        until the bucket is out of debt
+        '''
+        self.tokens = min(rate * BURST_SECONDS, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.used = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / rate
+
+class IoGovernor(object):
+    '''
+    bytes_per_sec, files_per_sec: read budgets for the whole process, 0 for none
+    max_load: 1 minute load average per CPU to stay under, 0 for none
+    max_io_pressure: % of time waiting on IO to stay under, 0 for none
+    '''
+    def __init__(self, bytes_per_sec=0, files_per_sec=0, max_load=0, max_io_pressure=0, verbose=False):
+        self.bytes_per_sec = bytes_per_sec
+        self.files_per_sec = files_per_sec
+        self.max_load = max_load
+        self.max_io_pressure = max_io_pressure
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        # user -> (bytes bucket, files bucket)
+        self.buckets = {}
+        # workers allowed are the ones asked for / 2**level
+        self.level = 0
+        self.over_limit = False
+        self.checked = 0
+
+    def _share(self, user, now):
+        for u, buckets in self.buckets.items():
+            if u != user and now - buckets[0].used > IDLE_SECONDS:
+                del self.buckets[u]
+        if user not in self.buckets:
+            self.buckets[user] = (_Bucket(now), _Bucket(now))
+        return self.buckets[user], len(self.buckets)
+
+    def _check_pressure(self, now):
+        if not (self.max_load or self.max_io_pressure) or now - self.checked < CHECK_SECONDS:
+            return
+        self.checked = now
+        load = read_load()
+        pressure = read_io_pressure()
+        over = bool((self.max_load and load is not None and load > self.max_load) or
+                    (self.max_io_pressure and pressure is not None and pressure > self.max_io_pressure))
+        if over:
+            self.level = min(self.level + 1, MAX_LEVEL)
+        elif self.level:
+            self.level -= 1
+        if self.verbose and over != self.over_limit:
+            print 'IO governor: load %s, IO pressure %s, %s'% (load, pressure, over and 'slowing down' or 'back to normal')
+        self.over_limit = over
+
+    def workers(self, workers):
+        '''
+        how many of workers may hash at once right now
+        '''
+        with self.lock:
+            self._check_pressure(time.time())
+            return max(1, workers >> self.level)
+
+    def read(self, size, user=None):
+        '''
+        Call before reading a file of size bytes for user's site, waits
+        until the budget allows it
+        '''
+        with self.lock:
+            now = time.time()
+            self._check_pressure(now)
+            (byte_bucket, file_bucket), users = self._share(user, now)
+            wait = 0
+            if self.bytes_per_sec:
+                wait = max(wait, byte_bucket.take(size, float(self.bytes_per_sec) / users, now))
+            if self.files_per_sec:
+                wait = max(wait, file_bucket.take(1, float(self.files_per_sec) / users, now))
+            if self.level >= PAUSE_LEVEL:
+                wait = max(wait, PAUSE_SECONDS)
+        if wait:
+            time.sleep(wait)
+
+# (limits) -> IoGovernor, see from_options()
+_governors = {}
+_governors_lock = threading.Lock()
+
+def from_options(options):
+    '''
+    The process wide governor for the limits in command line options,
+    None if none were given
+    '''
+    limits = (int(options.max_read_mb * 1024 * 1024), options.max_file_rate, options.max_load, options.max_io_pressure)
+    if not any(limits):
+        return None
+    with _governors_lock:
+        if limits not in _governors:
+            _governors[limits] = IoGovernor(*limits, verbose=options.verbose)
+        return _governors[limits]
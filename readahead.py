@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+'''
+Read files in the order they sit on disk, and leave the page cache as
+we found it
+
+os.walk() order jumps all over a disk, so readahead never gets going on
+spinning disks and NFS. Each directory's files are hashed in inode order
+instead, or in the order of their first extent on the device where the
+filesystem supports FIEMAP. A few files ahead of the hasher are handed
+to the kernel with posix_fadvise(WILLNEED) so their reads overlap the
+hashing, and once hashed, files that were not in the page cache before
+the scan are dropped from it again with DONTNEED. Files that were
+already cached, e.g. PHP that is being served, are left alone.
+
+Linux only, through ctypes; where a call isn't available the files are
+still read, just without the hints.
+'''
+
+import ctypes
+import ctypes.util
+import fcntl
+import mmap
+import os
+import stat
+import struct
+from collections import deque
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+# files handed to the kernel ahead of the one being hashed
+READAHEAD_FILES = 8
+
+# linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+# an extent not on disk yet, e.g. delayed allocation, has no offset
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_HEADER = struct.Struct('QQIIII')
+FIEMAP_EXTENT = struct.Struct('QQQQQIIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+try:
+    _libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+except AttributeError:
+    _libc = None
+
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+def fadvise(fd, advice, offset=0, length=0):
+    '''
+    posix_fadvise() on an open fd, length 0 is to the end of the file
+    '''
+    if _libc is not None:
+        _libc.posix_fadvise(fd, offset, length, advice)
+
+def is_cached(fd, size):
+    '''
+    True if any page of the file is in the page cache, None if we can't tell
+    '''
+    if _libc is None or not size:
+        return None
+    addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr in (None, MAP_FAILED):
+        return None
+    try:
+        pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+        vec = ctypes.create_string_buffer(pages)
+        if _libc.mincore(addr, size, vec) != 0:
+            return None
+        for c in vec.raw:
+            if ord(c) & 1:
+                return True
+        return False
+    finally:
+        _libc.munmap(addr, size)
+
+def first_extent(fd):
+    '''
+    Physical byte offset of a file's first extent, None if the
+    filesystem has no FIEMAP or the file has no extents on disk yet
+    No FIEMAP_FLAG_SYNC, writing back dirty pages of every file probed
+    is more IO than the ordering saves
+    '''
+    request = FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + '\0' * FIEMAP_EXTENT.size
+    try:
+        reply = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except IOError:
+        return None
+    if not FIEMAP_HEADER.unpack_from(reply)[3]:
+        return None
+    extent = FIEMAP_EXTENT.unpack_from(reply, FIEMAP_HEADER.size)
+    if extent[5] & FIEMAP_EXTENT_UNKNOWN:
+        return None
+    return extent[1]
+
+def _advise_path(path, advice):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, advice)
+    finally:
+        os.close(fd)
+
+class Readahead(object):
+    '''
+    use_extents: order by FIEMAP physical offset instead of inode
+    skip(path, st): true for files that won't be read, e.g. scan cache hits
+    '''
+    def __init__(self, use_extents=False, window=READAHEAD_FILES, skip=None):
+        self.use_extents = use_extents
+        self.window = window
+        self.skip = skip
+        # stat results of regular files from order(), for schedule()
+        self.stats = {}
+        # files we brought into the page cache, to drop once hashed
+        self.uncached = set()
+
+    def _key(self, path, st):
+        if self.use_extents:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                fd = None
+            if fd is not None:
+                try:
+                    offset = first_extent(fd)
+                finally:
+                    os.close(fd)
+                if offset is not None:
+                    return (st.st_dev, 0, offset)
+        # extentless files after the rest, by inode
+        return (st.st_dev, 1, st.st_ino)
+
+    def order(self, paths):
+        '''
+        paths of one directory sorted by where they are on disk
+        '''
+        keyed = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                # gone, hashing will report it
+                keyed.append(((1 << 64, 0, 0), path))
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                # opening a fifo or device would block, or worse
+                keyed.append(((st.st_dev, 1, st.st_ino), path))
+                continue
+            self.stats[path] = st
+            keyed.append((self._key(path, st), path))
+        keyed.sort()
+        return [path for key, path in keyed]
+
+    def _prefetch(self, path):
+        st = self.stats.pop(path, None)
+        if st is None or (self.skip and self.skip(path, st)):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            if is_cached(fd, st.st_size) is False:
+                self.uncached.add(path)
+            fadvise(fd, POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def schedule(self, paths):
+        '''
+        Yield paths, with the kernel reading the next few ahead of the
+        one yielded
+        '''
+        ahead = deque()
+        for path in paths:
+            self._prefetch(path)
+            ahead.append(path)
+            if len(ahead) > self.window:
+                yield ahead.popleft()
+        while ahead:
+            yield ahead.popleft()
+
+    def done(self, path):
+        '''
+        path has been hashed, drop it from the page cache if we put it there
+        '''
+        if path in self.uncached:
+            self.uncached.discard(path)
+            _advise_path(path, POSIX_FADV_DONTNEED)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Compact read-mostly {relative path: md5} for the checksums a scan
+checks files against
+
+Paths and 16 byte binary digests are interned, so a path or file that
+is the same in many loaded versions - core and addons across a
+multi-site run - is only held in memory once.  A file with several
+known good md5s (see get_wordpress_checksums) has a frozenset of them.
+
+Originals hashed with a sha256 as well (file_hashing.Digests) keep it,
+and a file whose md5 matches one of those must match its sha256 too.
+Originals with only an md5 are still checked by md5.
+'''
+
+from binascii import hexlify, unhexlify
+from collections import Mapping
+
+def _to_digest(md5):
+    if len(md5) in (32, 64):
+        try:
+            return unhexlify(md5)
+        except TypeError:
+            pass
+    # not an md5 or sha256 hexdigest, keep it as it is
+    return md5
+
+def _pack(md5):
+    return intern(_to_digest(md5))
+
+def _unpack(digest):
+    if len(digest) == 16:
+        return hexlify(digest)
+    return digest
+
+class ReferenceSet(Mapping):
+    '''
+    Reads like the {path: md5} dicts from ChecksumStore.get() - an md5
+    is a hexdigest, or a frozenset of them - but use matches() to
+    check a file, it skips converting back to hex
+    '''
+    def __init__(self, checksums=()):
+        self._digests = {}
+        # path -> {md5 digest: sha256 digest} for originals with a sha256
+        self._sha256s = {}
+        # (trie, dirs) of the paths, see WebappTripwire.get_dir_index()
+        self.dir_index = None
+        if checksums:
+            self.update(checksums)
+
+    def add(self, path, md5):
+        '''
+        md5: hexdigest or Digests, or a list of them. Adds to any md5s
+        path already has
+        '''
+        if isinstance(md5, basestring):
+            md5 = [md5]
+        path = intern(path)
+        self._add_digests(path, frozenset([_pack(m) for m in md5]))
+        for m in md5:
+            sha256 = getattr(m, 'sha256', None)
+            if sha256:
+                self._sha256s.setdefault(path, {})[_pack(m)] = _pack(sha256)
+
+    def _add_digests(self, path, digests):
+        self.dir_index = None
+        known = self._digests.get(path)
+        if known is not None:
+            if isinstance(known, frozenset):
+                digests = digests | known
+            else:
+                digests = digests | frozenset([known])
+        if len(digests) == 1:
+            for digest in digests:
+                self._digests[path] = digest
+        else:
+            self._digests[path] = digests
+
+    def update(self, checksums, prefix=''):
+        '''
+        Add a dict or ReferenceSet, with prefix + '/' before every path if given
+        '''
+        if prefix:
+            prefix = prefix.rstrip('/') + '/'
+        if isinstance(checksums, ReferenceSet):
+            self.dir_index = None
+            for path, digest in checksums._digests.iteritems():
+                if prefix:
+                    path = intern(prefix + path)
+                if path in self._digests:
+                    if not isinstance(digest, frozenset):
+                        digest = frozenset([digest])
+                    self._add_digests(path, digest)
+                else:
+                    self._digests[path] = digest
+            for path, sha256s in checksums._sha256s.iteritems():
+                if prefix:
+                    path = intern(prefix + path)
+                self._sha256s.setdefault(path, {}).update(sha256s)
+        else:
+            for path, md5 in checksums.iteritems():
+                self.add(prefix + path, md5)
+
+    def matches(self, path, md5):
+        '''
+        True if md5 is a known good md5 of path, False if it isn't,
+        None if path is not an original file at all
+        If md5 is Digests with a sha256 and the original it matches has
+        one, the sha256 decides
+        '''
+        try:
+            known = self._digests[path]
+        except KeyError:
+            return None
+        digest = _to_digest(md5)
+        if isinstance(known, frozenset):
+            found = digest in known
+        else:
+            found = digest == known
+        sha256 = getattr(md5, 'sha256', None)
+        if found and sha256 and path in self._sha256s and digest in self._sha256s[path]:
+            return _to_digest(sha256) == self._sha256s[path][digest]
+        return found
+
+    @property
+    def has_sha256(self):
+        '''
+        True if any original has a sha256, so files are worth hashing with it
+        '''
+        return bool(self._sha256s)
+
+    def __getitem__(self, path):
+        known = self._digests[path]
+        if isinstance(known, frozenset):
+            return frozenset([_unpack(d) for d in known])
+        return _unpack(known)
+
+    def __contains__(self, path):
+        return path in self._digests
+
+    def __iter__(self):
+        return iter(self._digests)
+
+    def __len__(self):
+        return len(self._digests)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Opt-in on-disk cache of file md5s keyed by absolute path
+
+An entry is only trusted while the file's
+(st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) are unchanged,
+so repeat scans only need to stat() files that have not changed.
+The sha256 is kept too when the file was hashed with one.
+'''
+
+import marshal
+import os
+from file_hashing import Digests
+
+# 2 added the sha256 to each entry
+CACHE_FORMAT = 2
+
+def stat_key(st):
+    '''
+    python 2 os.stat() has no st_*_ns fields so derive them from the floats
+    '''
+    try:
+        mtime_ns = st.st_mtime_ns
+        ctime_ns = st.st_ctime_ns
+    except AttributeError:
+        mtime_ns = int(st.st_mtime * 1000000000)
+        ctime_ns = int(st.st_ctime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+class ScanCache(object):
+    def __init__(self, cache_file, rehash_all=False, verbose=False):
+        self.cache_file = cache_file
+        # still record fresh hashes, just never trust the old ones
+        self.rehash_all = rehash_all
+        self.verbose = verbose
+        self.entries = {}
+        # entries stored since load(), see fleet.scan_fleet()
+        self.changed = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            f = open(self.cache_file, 'rb')
+        except IOError:
+            if self.verbose:
+                print 'No scan cache at %s, starting a new one'% (self.cache_file,)
+            return 0
+        try:
+            data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            data = {}
+        finally:
+            f.close()
+        if isinstance(data, dict) and data.get('format') == CACHE_FORMAT:
+            self.entries = data['entries']
+        elif isinstance(data, dict) and data.get('format') == 1:
+            # md5 only, still good
+            self.entries = dict([(p, (key, md5, None)) for p, (key, md5) in data['entries'].iteritems()])
+            self.dirty = True
+        elif self.verbose:
+            print 'Ignoring unreadable scan cache %s'% (self.cache_file,)
+        return len(self.entries)
+
+    def save(self):
+        '''
+        write to a temp file and rename so a killed run can't truncate the cache
+        '''
+        if not self.dirty:
+            return 0
+        tmp_file = '%s.%d.tmp'% (self.cache_file, os.getpid())
+        f = open(tmp_file, 'wb')
+        try:
+            marshal.dump({'format': CACHE_FORMAT, 'entries': self.entries}, f)
+        finally:
+            f.close()
+        os.rename(tmp_file, self.cache_file)
+        self.dirty = False
+        return len(self.entries)
+
+    def lookup(self, abs_path, key):
+        '''
+        file_hashing.Digests of abs_path if its stat_key() is still key
+        '''
+        if self.rehash_all:
+            return None
+        try:
+            cached_key, md5, sha256 = self.entries[abs_path]
+        except KeyError:
+            return None
+        if cached_key == key:
+            return Digests(md5, sha256)
+        return None
+
+    def store(self, abs_path, key, md5):
+        '''
+        md5: hexdigest or file_hashing.Digests
+        '''
+        entry = (key, str(md5), getattr(md5, 'sha256', None))
+        if self.entries.get(abs_path) != entry:
+            self.entries[abs_path] = entry
+            self.changed[abs_path] = entry
+            self.dirty = True
+
+    def merge(self, entries):
+        '''
+        add the changed entries of a copy of this cache in another process
+        '''
+        if entries:
+            self.entries.update(entries)
+            self.dirty = True
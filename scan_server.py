@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+Keep the checksum catalog and whitelist loaded between scans
+
+A scan run from cron pays for starting python, opening the checksum
+store and loading the same core and addon checksums for every site.
+The server does that once and then scans sites as clients ask, several
+at a time, with the same findings a command line run would print.
+
+Clients are the *_tripwire.py scripts with --socket, which send one
+request per path and print what comes back, e.g.
+
+    scan_server.py -j 4 &
+    wordpress_tripwire.py --socket webapp_tripwire.sock -c -n -p /users/bubba/public_html/bubba.com
+
+A request is a single JSON line on a new connection
+    {"webapp": "wordpress", "path": "/users/bubba/...", "options": {...}}
+where options are the client's command line options. The reply is the
+scan's output, then the server closes the connection.
+
+The socket is only usable by the user running the server, and the
+server's working directory holds the checksum database and whitelist
+just like for the scripts.
+'''
+
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+from optparse import OptionParser, Values
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from checksum_store import ChecksumStore
+from scan_cache import ScanCache
+from webapp_tripwire import print_site_error
+
+DEFAULT_SOCKET = 'webapp_tripwire.sock'
+# core and addon checksum sets kept loaded
+DEFAULT_RESIDENT_SETS = 512
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def _import_tripwires():
+    import drupal_tripwire
+    import joomla_tripwire
+    import wordpress_tripwire
+    return {
+        'drupal': drupal_tripwire,
+        'joomla': joomla_tripwire,
+        'wordpress': wordpress_tripwire,
+    }
+
+class ScanRequestHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            module = self.server.tripwires[request['webapp']]
+            fs_path = request['path'].encode('utf-8')
+            options = Values(request['options'])
+        except KeyError as e:
+            self.wfile.write('Bad scan request: no %s\n'% (e,))
+            return
+        except (ValueError, TypeError, AttributeError) as e:
+            self.wfile.write('Bad scan request: %s\n'% (e,))
+            return
+        # fork()ing hashing processes from a threaded server is asking
+        # for trouble, hash in threads instead
+        options.use_threads = True
+        with self.server.slots:
+            if self.server.verbose:
+                print 'Scanning %s as %s'% (fs_path, request['webapp'])
+            try:
+                module.scan_site(fs_path, options, self.server.cache, self.wfile)
+            except socket.error:
+                # client went away
+                pass
+            except SystemExit:
+                # the checksum getters sys.exit() when a download fails,
+                # that only ends this scan
+                print_site_error(fs_path, 'Scan failed: unable to get checksums', getattr(options, 'json_lines', False), self.wfile)
+            except Exception as e:
+                print_site_error(fs_path, 'Scan failed: %s'% (e,), getattr(options, 'json_lines', False), self.wfile)
+
+class ScanServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, jobs=2, cache=None, verbose=False):
+        if os.path.exists(socket_file):
+            os.unlink(socket_file)
+        # owner only, before the socket exists
+        old_umask = os.umask(0177)
+        try:
+            UnixStreamServer.__init__(self, socket_file, ScanRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.socket_file = socket_file
+        # more requests than this wait their turn
+        self.slots = threading.BoundedSemaphore(jobs)
+        self.cache = cache
+        self.verbose = verbose
+        self.tripwires = _import_tripwires()
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_file)
+        except OSError:
+            pass
+
+def request_scan(socket_file, webapp, fs_path, options, stream=None):
+    '''
+    Have the server at socket_file scan fs_path with the options of a
+    *_tripwire.py command line, copying its output to stream (stdout by
+    default) as it arrives
+    '''
+    if stream is None:
+        stream = sys.stdout
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+        client.sendall(json.dumps({'webapp': webapp, 'path': fs_path, 'options': vars(options)}) + '\n')
+        reply = client.makefile('rb')
+        for line in reply:
+            stream.write(line)
+            stream.flush()
+        reply.close()
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    usage = '%s [options]\n'% (os.path.basename(__file__),)
+    usage += '''
+Serve scan requests from wordpress_tripwire.py, drupal_tripwire.py and
+joomla_tripwire.py --socket, with checksums kept loaded between them
+    '''
+    parser = OptionParser(usage=usage)
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      dest="verbose", help="verbose output")
+    parser.add_option("-s", "--socket", dest="socket_file", type="string", action="store", default=DEFAULT_SOCKET,
+                      help="listen on this Unix socket (default %s)"% (DEFAULT_SOCKET,))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", action="store", default=2,
+                      help="number of scans to run at once, more requests wait (default 2)")
+    parser.add_option("--resident-sets", dest="resident_sets", type="int", action="store", default=DEFAULT_RESIDENT_SETS,
+                      help="number of checksum sets to keep loaded (default %d)"% (DEFAULT_RESIDENT_SETS,))
+    parser.add_option("--cache", dest="cache_file", type="string", action="store", default=None,
+                      help="reuse md5s of files unchanged since the last scan, stored in this file, saved on exit")
+    (options, args) = parser.parse_args()
+
+    ChecksumStore.enable_cache(options.resident_sets)
+    cache = None
+    if options.cache_file:
+        cache = ScanCache(options.cache_file, verbose=options.verbose)
+        cache.load()
+    server = ScanServer(options.socket_file, options.jobs, cache, options.verbose)
+    signal.signal(signal.SIGTERM, _interrupt)
+    if options.verbose:
+        print 'Listening on %s'% (options.socket_file,)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if cache:
+        cache.save()
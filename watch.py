@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+Keep verifying webapp files as they are written, on Linux
+
+After a full scan, the scanned directories of each site get an inotify
+watch. Only files that are created, written or moved in are checked
+against the already loaded checksums and whitelist, so a dropped file
+is reported within seconds and the cost follows the write rate instead
+of the number of files.
+
+Uses the inotify syscalls through ctypes, nothing to install.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import struct
+import time
+from webapp_tripwire import IgnoreMatcher, print_finding
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct('iIII')
+# wait this long after a file's last event before checking it,
+# so a file still being written is checked once it is done
+SETTLE_SECONDS = 1.0
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: %s'% (os.strerror(e),))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC:
+                raise OSError(e, 'out of inotify watches, raise fs.inotify.max_user_watches', path)
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read_events(self):
+        '''
+        [(wd, mask, name)] of the events queued so far
+        '''
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def _watch_dirs(tw):
+    '''
+    get_scanned_dirs() less the ones a scan would skip
+    '''
+    ignore_dirs = set(tw.ignore_dirs)
+    for d in sorted(tw.get_scanned_dirs()):
+        if not ignore_dirs.intersection(tw.get_relative_path(d).split('/')):
+            yield d
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def watch(tripwires, json_lines=False, verbose=False, stream=None):
+    '''
+    Watch the sites of tripwires - WebappTripwires with their checksums
+    loaded, i.e. already scanned - and print findings for files as they
+    are written, to stream (stdout by default). Runs until interrupted,
+    SIGTERM raises KeyboardInterrupt too so the caller can clean up
+    either way.
+    '''
+    signal.signal(signal.SIGTERM, _interrupt)
+    inotify = Inotify()
+    # wd -> [(tripwire, dir)], sites may share a directory
+    watches = {}
+    matchers = {}
+    for tw in tripwires:
+        matchers[tw] = IgnoreMatcher(tw.ignore_dirs, tw.ignore_files, tw.ignore_types, tw.ignore_globs)
+        for d in _watch_dirs(tw):
+            try:
+                wd = inotify.add_watch(d)
+            except OSError as e:
+                # e.g. a plugin dir the site doesn't have
+                if e.errno != errno.ENOENT or verbose:
+                    print 'Cannot watch %s: %s'% (d, e.strerror)
+                continue
+            watches.setdefault(wd, []).append((tw, d))
+    if verbose:
+        print 'Watching %d directories of %d sites'% (len(watches), len(tripwires))
+    # (tripwire, file) -> time of its last event
+    pending = {}
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.itervalues()) + SETTLE_SECONDS - time.time())
+            readable = select.select([inotify.fd], [], [], timeout)[0]
+            if readable:
+                now = time.time()
+                for wd, mask, name in inotify.read_events():
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, check everything again
+                        if verbose:
+                            print 'inotify queue overflowed, rescanning'
+                        pending.clear()
+                        for tw in tripwires:
+                            for f, error in tw.scan_iter():
+                                print_finding(tw, f, error, json_lines, stream)
+                        continue
+                    if mask & IN_IGNORED:
+                        # directory removed
+                        watches.pop(wd, None)
+                        continue
+                    if mask & IN_ISDIR or not name:
+                        continue
+                    for tw, d in watches.get(wd, []):
+                        pending[(tw, os.path.join(d, name))] = now
+            now = time.time()
+            for key, last_event in pending.items():
+                if now - last_event < SETTLE_SECONDS:
+                    continue
+                del pending[key]
+                tw, abs_path = key
+                if matchers[tw].match(os.path.basename(abs_path)) or not os.path.isfile(abs_path):
+                    continue
+                error = tw.check_file_sum(abs_path)
+                if error:
+                    print_finding(tw, abs_path, error, json_lines, stream)
+    finally:
+        inotify.close()
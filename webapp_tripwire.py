@@ -1,19 +1,156 @@
 #!/usr/bin/env python2.7
 
-import hashlib
+import json
 import re
 import subprocess
 import sys
 import os
+import threading
+import time
+from collections import deque
+from distutils.version import LooseVersion
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pwd import getpwuid
-from types import *
+from checkpoint import Checkpoint
+from checksum_store import ChecksumStore, build_dir_index
+from file_hashing import digests_file
+from fingerprint import vote as fingerprint_vote
+from readahead import Readahead
+from reference_set import ReferenceSet
+from scan_cache import stat_key
+
+def json_text(value):
+    '''
+    value with its byte strings decoded for json.dumps(), bytes that
+    aren't UTF-8 become U+FFFD rather than failing the whole output
+    '''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict([(json_text(k), json_text(v)) for k, v in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [json_text(v) for v in value]
+    return value
+
+def json_path(fields, key, path):
+    '''
+    Set fields[key] to path as text. A path that isn't UTF-8 also gets
+    its exact bytes in hex as fields[key + '_hex']
+    '''
+    fields[key] = json_text(path)
+    if isinstance(path, str):
+        try:
+            path.decode('utf-8')
+        except UnicodeDecodeError:
+            fields[key + '_hex'] = path.encode('hex')
+
+def finding_json(docroot, webapp, version, abs_path, error):
+    '''
+    One finding as a line of JSON, see print_finding()
+    '''
+    finding = {'webapp': json_text(webapp), 'version': json_text(version), 'error': json_text(error)}
+    json_path(finding, 'docroot', docroot)
+    json_path(finding, 'file', abs_path)
+    return json.dumps(finding, sort_keys=True)
+
+def print_finding(tw, abs_path, error, json_lines=False, stream=None):
+    '''
+    Print one scan finding to stream (stdout by default), as a JSON
+    object per line if json_lines
+    Flushed right away so a log pipeline reading our output sees it
+    '''
+    if stream is None:
+        stream = sys.stdout
+    if json_lines:
+        webapp, version = tw.get_owner(abs_path)
+        print >>stream, finding_json(tw.docroot, webapp, version, abs_path, error)
+    else:
+        print >>stream, '%s %s'% (error, abs_path)
+    stream.flush()
+
+def print_site_error(docroot, error, json_lines=False, stream=None):
+    '''
+    Print a problem with a whole site, e.g. a scan that failed, like a
+    finding with no file
+    '''
+    if stream is None:
+        stream = sys.stdout
+    if json_lines:
+        print >>stream, finding_json(docroot, None, None, None, error)
+    else:
+        print >>stream, '%s %s'% (error, docroot)
+    stream.flush()
+
+def print_details(tw, json_lines=False, extra={}, stream=None):
+    '''
+    Print what webapp and version tw looks like, plus extra fields
+    in JSON mode
+    '''
+    if stream is None:
+        stream = sys.stdout
+    if json_lines:
+        details = {'webapp': json_text(tw.webapp_name), 'version': json_text(tw.webapp_version)}
+        json_path(details, 'docroot', tw.docroot)
+        details.update(json_text(extra))
+        print >>stream, json.dumps(details, sort_keys=True)
+    else:
+        print >>stream, tw.get_webapp_details()
+    stream.flush()
+
+def hash_file(job):
+    '''
+    Worker for parallel scans - job is (abs_path, stat_key, md5, sha256)
+    md5 is already set on a scan cache hit, otherwise hash the file,
+    with a sha256 as well if sha256
+    md5 is None in the result if the file cannot be read
+    '''
+    abs_path, key, md5, sha256 = job
+    if md5 is None:
+        try:
+            md5 = digests_file(abs_path, sha256)
+        except EnvironmentError:
+            md5 = None
+    return (abs_path, key, md5)
+
+# the whitelist dict is shared by every WebappTripwire (see get_whitelist()),
+# this keeps concurrent scans in one process from writing it at once
+_whitelist_lock = threading.RLock()
+
+class IgnoreMatcher(object):
+    '''
+    ignore_files, ignore_types and ignore_globs compiled once per scan
+    Checking a file name costs a set lookup per distinct suffix length
+    plus a single regex search
+    '''
+    def __init__(self, ignore_dirs=[], ignore_files=[], ignore_types=[], ignore_globs=[]):
+        self.ignore_dirs = frozenset(ignore_dirs)
+        self.ignore_files = frozenset(ignore_files)
+        self.ignore_types = frozenset(ignore_types)
+        self.type_lengths = sorted(set([len(t) for t in ignore_types]), reverse=True)
+        self.globs_re = None
+        if ignore_globs:
+            self.globs_re = re.compile('|'.join(['(?:%s)'% (g.pattern,) for g in ignore_globs]))
+
+    def match(self, f):
+        '''
+        Return why file name f is ignored, or None
+        '''
+        if f in self.ignore_files:
+            return 'ignored file'
+        for n in self.type_lengths:
+            if f[-n:] in self.ignore_types:
+                return 'ignored file type "%s"'% (f[-n:],)
+        if self.globs_re and self.globs_re.search(f):
+            return 'ignored file'
+        return None
 
 class WebappTripwire(object):
     '''
     Compare checksums of web application core files with original versions
     Look for unexpected files interspersed with original web app files
     '''
-    def __init__(self, docroot='/tmp', ignore_dirs=[], ignore_files=[], ignore_types=[], verbose=False, checksums={}, exclude_files=False, webapp_name='', check_changed_files=False, check_new_files=False):
+    def __init__(self, docroot='/tmp', ignore_dirs=[], ignore_files=[], ignore_types=[], verbose=False, checksums={}, exclude_files=False, webapp_name='', check_changed_files=False, check_new_files=False, workers=1, use_threads=False, cache=None, fingerprint=False, io_governor=None, readahead=None, deadline=None, checkpoint_dir=None):
         self.docroot = docroot
         self.checksums = checksums
         self.exclude_files = exclude_files
@@ -34,142 +171,462 @@ class WebappTripwire(object):
         self.verbose = verbose
         self.webapp_name = webapp_name
         self.webapp_version = 'Unknown version'
+        # {relative dir: (webapp, version)} of other webapps' checksums
+        # added to ours, e.g. WP addons, see get_owner()
+        self.owners = {}
         self.check_changed_files = check_changed_files
         self.check_new_files = check_new_files
         self.empty_file_md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+        # number of hashing workers - processes, or threads if use_threads
+        self.workers = workers
+        self.use_threads = use_threads
+        # optional scan_cache.ScanCache
+        self.cache = cache
+        # optional precomputed build_dir_index(checksums)
+        self.dir_index = None
+        self.checksum_store = ChecksumStore()
+        # cross-check the version file with fingerprint.vote(), see detect_webapp_version()
+        self.fingerprint = fingerprint
+        self.version_mismatch = None
+        # optional io_governor.IoGovernor to pace reads with
+        self.io_governor = io_governor
+        # None, or 'inode' / 'extent' to hash each directory's files in
+        # that order with readahead, see readahead.Readahead
+        self.readahead_mode = readahead
+        self.readahead = None
+        if readahead:
+            self.readahead = Readahead(readahead == 'extent', skip=self.is_cache_hit)
+        # time.time() to stop scanning at, and where to save how far we got
+        self.deadline = deadline
+        self.checkpoint_dir = checkpoint_dir
+        # Checkpoint of the scan running now, see scan_iter()
+        self.checkpoint = None
         self.get_whitelist()
 
     def get_username(self):
         index_file = os.path.join(self.docroot, 'index.php')
         return getpwuid(os.stat(index_file).st_uid).pw_name
 
+    def detect_webapp_version(self):
+        '''
+        get_webapp_version(), checked against the files themselves when
+        fingerprint is on. If the version file is missing, or names a
+        version we have checksums for that the files don't match, the
+        version with the most fingerprint votes is used instead. Only
+        done once.
+        '''
+        try:
+            return self.detected_version
+        except AttributeError:
+            pass
+        version = self.get_webapp_version()
+        if self.fingerprint and version and not self.checksum_store.has(self.webapp_name, version):
+            # votes only go to versions in the store, a release newer than
+            # our checksums would lose to an older one - trust the version
+            # file and let get_checksums() fetch it
+            if self.verbose:
+                print 'No checksums for %s %s yet, not checking it against the files'% (self.webapp_name, version)
+        elif self.fingerprint:
+            votes, versions = fingerprint_vote(self.checksum_store, self.webapp_name, self.docroot, self.verbose)
+            if versions and version not in versions:
+                if version:
+                    # reported by scan_iter()
+                    self.version_mismatch = 'Version file says %s but files match %s'% (version, ' '.join(versions))
+                elif self.verbose:
+                    print '%s has no version file but its files match %s %s'% (self.docroot, self.webapp_name, ' '.join(versions))
+                # newest of the best matches
+                version = versions[-1]
+                self.webapp_version = version
+        self.detected_version = version
+        return version
+
     def get_webapp_details(self):
         return '%s looks like %s version %s'% (self.docroot, self.webapp_name, self.webapp_version)
 
     def check_file_sum(self, abs_path):
-        original_md5 = self.get_original_md5(abs_path)
         try:
             curr_md5 = self.get_curr_md5(abs_path)
-        except IOError:
-            self.found_suspect_file(abs_path, 'Cannot read file', '# cannot read file #')
-            return 
-        if self.check_new_files and not original_md5: 
-            self.found_suspect_file(abs_path, 'Unexpected file', curr_md5)
-        elif self.check_changed_files and original_md5: 
-            if isinstance(original_md5, StringTypes):
-                if original_md5 != curr_md5:
-                    self.found_suspect_file(abs_path, 'Modified file', curr_md5)
-                    if self.verbose:
-                        print "File modified: %s"% (abs_path,)
-                elif self.verbose:
-                    print "File not modified: %s"% (abs_path,)
-            else:
-                # iterate through multiple possible hashes
-                sums_match = False
-                for i in original_md5:
-                    if i == curr_md5:
-                        sums_match = True
-                if not sums_match:
-                    self.found_suspect_file(abs_path, 'Modified file', curr_md5)
-                elif self.verbose:
-                    print "File not modified: %s"% (abs_path,)
+        except EnvironmentError:
+            curr_md5 = None
+        return self.check_file_md5(abs_path, curr_md5)
+
+    def check_file_md5(self, abs_path, curr_md5):
+        '''
+        Compare an already computed md5 with the original
+        curr_md5 is None if the file could not be read
+        Return the error for a suspect file, otherwise None
+        '''
+        if curr_md5 is None:
+            return self.found_suspect_file(abs_path, 'Cannot read file', '# cannot read file #')
+        # True/False, or None if there is no original
+        original = self.checksums.matches(self.get_relative_path(abs_path), curr_md5)
+        if self.check_new_files and original is None: 
+            return self.found_suspect_file(abs_path, 'Unexpected file', curr_md5)
+        elif self.check_changed_files and original is not None: 
+            if not original:
+                if self.verbose:
+                    print "File modified: %s"% (abs_path,)
+                return self.found_suspect_file(abs_path, 'Modified file', curr_md5)
+            elif self.verbose:
+                print "File not modified: %s"% (abs_path,)
+        return None
+
+    def describe_known_md5(self, abs_path, md5):
+        '''
+        ' (matches webapp version)' if a flagged file is an original file
+        from some version we have checksums for - e.g. left behind by a
+        half finished upgrade - otherwise ''
+        Prefers the same file of the same webapp, then the newest version
+        '''
+        rel_path = self.get_relative_path(abs_path)
+        best = None
+        for webapp, version, path in self.checksum_store.find_md5(md5):
+            same_path = (rel_path == path or rel_path.endswith('/' + path))
+            rank = (same_path, webapp == self.webapp_name, LooseVersion(version))
+            if best is None or rank > best[0]:
+                best = (rank, webapp, version, path)
+        if best is None:
+            return ''
+        rank, webapp, version, path = best
+        if rank[0]:
+            return ' (matches %s %s)'% (webapp, version)
+        return ' (matches %s %s %s)'% (webapp, version, path)
 
     def found_suspect_file(self, abs_path, reason, md5):
+        '''
+        Return the error to report for a suspect file,
+        None if it is empty or whitelisted and unchanged
+        '''
         if md5 == self.empty_file_md5:
             if self.verbose:
                 print "Skipping empty file: %s"% (abs_path,)
-        elif abs_path in self.whitelist:
-            if self.whitelist[abs_path] != md5:
-                reason = 'Whitelisted file modified'
-                self.suspect_files[abs_path] = reason
-                if self.verbose:
-                    print "%s: %s"% (reason, abs_path,)
-        else:
-            self.suspect_files[abs_path] = reason
-            if self.verbose:
-                print "%s: %s"% (reason, abs_path,)
+            return None
+        if abs_path in self.whitelist:
+            if self.whitelist[abs_path] == md5:
+                return None
+            reason = 'Whitelisted file modified'
+        reason += self.describe_known_md5(abs_path, md5)
+        if self.verbose:
+            print "%s: %s"% (reason, abs_path,)
+        return reason
 
     def scan(self):
-        suspect_files = {}
+        '''
+        Return a dict of {file: error}
+        '''
+        for abs_path, error in self.scan_iter():
+            self.suspect_files[abs_path] = error
+        return self.suspect_files
+
+    def scan_iter(self):
+        '''
+        Yield (file, error) for each suspect file as soon as it is found,
+        in walk order, without keeping them
+        With a checkpoint_dir, an unfinished earlier scan is picked up
+        where it stopped and its findings are yielded first. Past the
+        deadline the scan stops and says so.
+        '''
         if not (self.check_new_files or self.check_changed_files):
             print "No scan was selected (new files or changed files) so nothing to be done"
-            return suspect_files 
-        scanned_dirs = self.get_scanned_dirs()
-        for root, dirs, files in os.walk(self.docroot):
-            original_md5 = ''
-            for d in self.ignore_dirs:
-                if d in root.split('/'):    
-                    if self.verbose:
-                        print "Skipping ignored directory %s "% (root,)
-                    files = ()
-            if root not in scanned_dirs:
-                if self.verbose:
-                    print "Skipping directory %s "% (root,)
-                files = ()
-            for f in files:
-                check_file = True
-                abs_path = (os.path.join(root, f))
-                if f in self.ignore_files:
-                    check_file = False
-                    if self.verbose:
-                        print 'Skipping ignored file %s'% (abs_path,)
-                for filetype in self.ignore_types:
-                    if f.endswith(filetype):
-                        check_file = False
-                        if self.verbose:
-                            print 'Skipping ignored file type "%s" %s'% (filetype, abs_path,)
-                for glob in self.ignore_globs:
-                    if re.search(glob, f):
-                        check_file = False
-                        if self.verbose:
-                            print 'Skipping ignored file %s'% (abs_path,)
-                if check_file:
-                    self.check_file_sum(abs_path)
-        if self.exclude_files:
-            # add suspect files to permanent whitelist
-            for abs_path in self.suspect_files.keys():
+            return
+        if self.version_mismatch:
+            yield (self.docroot, self.version_mismatch)
+        self.checkpoint = None
+        if self.checkpoint_dir:
+            self.checkpoint = Checkpoint(self.checkpoint_dir, self)
+            self.checkpoint.load()
+            for finding in self.checkpoint.findings:
+                yield finding
+        if self.out_of_time():
+            yield (self.docroot, self.stop_scan())
+            return
+        if self.workers > 1:
+            results = self.scan_parallel()
+        else:
+            results = ((abs_path, self.check_file_sum(abs_path)) for abs_path in self.get_scheduled_files())
+        for abs_path, error in results:
+            if self.out_of_time():
+                # abs_path isn't recorded as checked, the next scan does it again
+                results.close()
+                yield (self.docroot, self.stop_scan())
+                return
+            if self.readahead:
+                self.readahead.done(abs_path)
+            if error is not None and self.exclude_files:
+                # add suspect files to permanent whitelist
                 self.add_to_whitelist(abs_path)
-                del(self.suspect_files[abs_path])
                 if self.verbose:
                     print 'Added to whitelist: %s'% (abs_path,)
-        return self.suspect_files
+                error = None
+            if self.checkpoint:
+                self.checkpoint.checked(abs_path, error)
+            if error is not None:
+                yield (abs_path, error)
+        if self.checkpoint:
+            self.checkpoint.remove()
+            self.checkpoint = None
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def stop_scan(self):
+        '''
+        Save the checkpoint if there is one, and return what to report
+        '''
+        if self.checkpoint:
+            self.checkpoint.save()
+            self.checkpoint = None
+            return 'Scan incomplete, out of time - the next scan goes on from here'
+        return 'Scan incomplete, out of time'
+
+    def scan_parallel(self):
+        '''
+        Walk in this process and hash in a pool of workers
+        Yields (file, error or None) for every file checked, in walk
+        order like a serial scan since imap() keeps the order
+        '''
+        if self.use_threads:
+            pool = ThreadPool(self.workers)
+        else:
+            pool = Pool(self.workers)
+        try:
+            jobs = (self.get_hash_job(abs_path) for abs_path in self.get_scheduled_files())
+            if self.io_governor is None and self.readahead is None:
+                results = pool.imap(hash_file, jobs, 16)
+            else:
+                results = self.bounded_imap(pool, jobs)
+            for abs_path, key, curr_md5 in results:
+                if key and curr_md5:
+                    self.cache.store(abs_path, key, curr_md5)
+                yield (abs_path, self.check_file_md5(abs_path, curr_md5))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def bounded_imap(self, pool, jobs):
+        '''
+        pool.imap(hash_file, jobs) with only a few files in flight - as
+        many as the io_governor allows right now, each read paid for
+        before it is handed to a worker - where imap() would queue every
+        job at once, running readahead far ahead of the hashing
+        '''
+        pending = deque()
+        for job in jobs:
+            if self.io_governor is None:
+                limit = self.workers * 2
+            else:
+                limit = self.io_governor.workers(self.workers)
+            while pending and len(pending) >= limit:
+                yield pending.popleft().get()
+            if job[2] is None:
+                self.throttle_read(job[0])
+            pending.append(pool.apply_async(hash_file, (job,)))
+        while pending:
+            yield pending.popleft().get()
+
+    def throttle_read(self, filepath, st=None):
+        '''
+        wait until the io_governor, if any, lets us read filepath
+        '''
+        if self.io_governor is None:
+            return
+        if st is None:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                return
+        try:
+            user = self.io_user
+        except AttributeError:
+            try:
+                user = self.get_username()
+            except (OSError, KeyError):
+                # no index.php, or an owner with no passwd entry
+                user = None
+            self.io_user = user
+        self.io_governor.read(st.st_size, user)
+
+    def is_cache_hit(self, abs_path, st):
+        return self.cache is not None and self.cached_md5(abs_path, stat_key(st)) is not None
+
+    def get_scheduled_files(self):
+        '''
+        get_files_to_check(), with readahead if it is on
+        '''
+        if self.readahead:
+            return self.readahead.schedule(self.get_files_to_check())
+        return self.get_files_to_check()
+
+    def get_files_to_check(self):
+        '''
+        Generator of files to hash, after ignore rules are applied
+        Ignored directories are pruned from the walk so they are never entered
+        '''
+        matcher = IgnoreMatcher(self.ignore_dirs, self.ignore_files, self.ignore_types, self.ignore_globs)
+        for d in self.docroot.split('/'):
+            if d in matcher.ignore_dirs:
+                if self.verbose:
+                    print "Skipping ignored directory %s "% (self.docroot,)
+                return
+        scanned_dirs = self.get_scanned_dirs()
+        # only walk directories that exist in the original source tree
+        trie, _ = self.get_dir_index()
+        trie_nodes = {self.docroot: trie}
+        for root, dirs, files in os.walk(self.docroot):
+            node = trie_nodes.pop(root)
+            if self.verbose:
+                for d in dirs:
+                    if d in matcher.ignore_dirs:
+                        print "Skipping ignored directory %s "% (os.path.join(root, d),)
+                    elif d not in node:
+                        print "Skipping directory %s "% (os.path.join(root, d),)
+            # sorted, so a checkpoint can tell where a walk got to
+            dirs[:] = sorted([d for d in dirs if d in node and d not in matcher.ignore_dirs])
+            skip_files = set()
+            if self.checkpoint:
+                rel_root = self.get_relative_path(root)
+                dirs[:] = [d for d in dirs if not self.checkpoint.skip_dir(rel_root and '%s/%s'% (rel_root, d) or d)]
+                skip_files = self.checkpoint.skip_files(rel_root)
+            for d in dirs:
+                trie_nodes[os.path.join(root, d)] = node[d]
+            if root not in scanned_dirs or skip_files is None:
+                continue
+            batch = []
+            for f in sorted(files):
+                if f in skip_files:
+                    continue
+                reason = matcher.match(f)
+                if reason:
+                    if self.verbose:
+                        print 'Skipping %s %s'% (reason, os.path.join(root, f),)
+                else:
+                    batch.append(os.path.join(root, f))
+            if self.readahead:
+                batch = self.readahead.order(batch)
+            for abs_path in batch:
+                yield abs_path
+
+    def get_hash_job(self, abs_path):
+        '''
+        (abs_path, stat_key, md5, sha256) for hash_file()
+        stat_key is only set when there is a scan cache to update
+        '''
+        sha256 = self.checksums.has_sha256
+        if self.cache is None:
+            return (abs_path, None, None, sha256)
+        try:
+            key = stat_key(os.stat(abs_path))
+        except OSError:
+            return (abs_path, None, None, sha256)
+        return (abs_path, key, self.cached_md5(abs_path, key), sha256)
+
+    def cached_md5(self, abs_path, key):
+        '''
+        Digests from the scan cache, unless the originals have sha256s
+        and the cached entry doesn't
+        '''
+        md5 = self.cache.lookup(abs_path, key)
+        if md5 is not None and md5.sha256 is None and self.checksums.has_sha256:
+            return None
+        return md5
 
     def get_curr_md5(self, filepath):
-        file_to_check = open(filepath)
-        data = file_to_check.read()    
-        file_to_check.close()
-        return hashlib.md5(data).hexdigest()
+        '''
+        file_hashing.Digests of filepath, with the sha256 when any
+        original has one to check it against
+        '''
+        if self.cache is None:
+            self.throttle_read(filepath)
+            return digests_file(filepath, self.checksums.has_sha256)
+        st = os.stat(filepath)
+        key = stat_key(st)
+        md5 = self.cached_md5(filepath, key)
+        if md5 is None:
+            self.throttle_read(filepath, st)
+            md5 = digests_file(filepath, self.checksums.has_sha256)
+            self.cache.store(filepath, key, md5)
+        return md5
 
-    def get_original_md5(self, filepath):
+    def get_owner(self, abs_path):
+        '''
+        (webapp, version) whose originals abs_path is checked against -
+        the owner of the closest directory above it in owners, or ours
+        '''
+        if self.owners:
+            parts = self.get_relative_path(abs_path).split('/')[:-1]
+            while parts:
+                owner = self.owners.get('/'.join(parts))
+                if owner:
+                    return owner
+                parts.pop()
+        return (self.webapp_name, self.webapp_version)
+
+    def get_relative_path(self, filepath):
         # get fs path relative to wp install
-        f = filepath.replace(self.docroot, '').strip('/')
+        return filepath.replace(self.docroot, '').strip('/')
+
+    def get_original_md5(self, filepath):
+        '''
+        md5 of the original file, a frozenset of md5s if there are several,
+        or None if there is no original
+        '''
         try:
-            return self.checksums[f]
+            return self.checksums[self.get_relative_path(filepath)]
         except KeyError:
             pass
         return None
+
+    @property
+    def checksums(self):
+        return self._checksums
+
+    @checksums.setter
+    def checksums(self, checksums):
+        '''
+        plain {path: md5} dicts are converted to a ReferenceSet
+        '''
+        if not isinstance(checksums, ReferenceSet):
+            checksums = ReferenceSet(checksums)
+        self._checksums = checksums
     
+    def load_checksums(self):
+        '''
+        checksums for webapp_name/webapp_version from the checksum store
+        KeyError if the store has none
+        '''
+        self.checksums = self.checksum_store.get_reference_set(self.webapp_name, self.webapp_version)
+        self.dir_index = self.checksum_store.get_dir_index(self.webapp_name, self.webapp_version)
+
+    def get_dir_index(self):
+        '''
+        (trie, dirs) for the current checksums, built once per checksum set
+        '''
+        if self.dir_index:
+            return self.dir_index
+        if self.checksums.dir_index is None:
+            # kept with the checksums, so it goes when they do
+            self.checksums.dir_index = build_dir_index(self.checksums)
+        return self.checksums.dir_index
+
     def get_scanned_dirs(self):
         '''
-        list of directories we have checksums for
-        '''
-        scanned_dirs = {self.docroot: ''}
-        # sorry not sorry
-        # strip filename from checksum file and prepend docroot
-        # e.g. wp-admin/index.php -> /users/bubba/public_html/wp-admin
-        # os.sep == '/' 
-        relative_paths = ['/'.join(f.split('/')[:-1]) for f in self.checksums.keys() if '/' in f]
-        for p in relative_paths:
-            d = os.path.join(self.docroot, p)
-            scanned_dirs[d] = ''
-        return scanned_dirs.keys()
+        set of directories we have checksums for
+        e.g. wp-admin/index.php -> /users/bubba/public_html/wp-admin
+        '''
+        trie, dirs = self.get_dir_index()
+        return set([os.path.join(self.docroot, d) if d else self.docroot for d in dirs])
     
     def add_to_whitelist(self, filepath):
         try:
-            self.whitelist[filepath] = self.get_curr_md5(filepath)
-        except IOError:
-            self.whitelist[filepath] = '# cannot read file #'
-        self.update_whitelist_file()
+            md5 = self.get_curr_md5(filepath)
+        except EnvironmentError:
+            md5 = '# cannot read file #'
+        with _whitelist_lock:
+            self.whitelist[filepath] = md5
+            self.update_whitelist_file()
 
     def get_whitelist(self):
         try:
@@ -180,14 +637,19 @@ class WebappTripwire(object):
             self.update_whitelist_file()
 
     def remove_from_whitelist(self, filepath):
-        for f in self.whitelist.keys():
-            if filepath in f:
-                del(self.whitelist[f])
-                if self.verbose:
-                    print "removed from whitelist %s"% (f,)
-        self.update_whitelist_file()
+        with _whitelist_lock:
+            for f in self.whitelist.keys():
+                if filepath in f:
+                    del(self.whitelist[f])
+                    if self.verbose:
+                        print "removed from whitelist %s"% (f,)
+            self.update_whitelist_file()
 
     def update_whitelist_file(self):
+        with _whitelist_lock:
+            self._write_whitelist_file()
+
+    def _write_whitelist_file(self):
         f = open(self.whitelist_file, 'w')
         f.write("""#!/usr/bin/env python
 # Autogenerated by swcp webapp integrity checker
@@ -1,15 +1,25 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import sys
+import time
 from optparse import OptionParser
 from os import setuid, stat
-from os.path import basename, join
-from subprocess import call, check_output, CalledProcessError
+from os.path import basename, islink, join, relpath
+from multiprocessing.pool import ThreadPool
 from pwd import getpwuid
 import get_wordpress_checksums
+from checksum_store import ChecksumStore
+from reference_set import ReferenceSet
 from get_wordpress_addon_checksums import WpAddonChecksums
-from webapp_tripwire import WebappTripwire
+from fleet import scan_fleet
+import io_governor
+from scan_cache import ScanCache
+from scan_server import request_scan
+from webapp_tripwire import WebappTripwire, print_details, print_finding
+from watch import watch
+import wp_inventory
 
 webapp_name = 'wordpress-core'
 ignore_files = ['error_log', 'wp-config.php',]
@@ -17,19 +27,14 @@ ignore_files = ['error_log', 'wp-config.php',]
 class WordpressTripwire(WebappTripwire):
     def get_checksums(self):
         try:
-            import webapp_checksums # dict of md5sums of original webapp source files 
-            self.checksums = webapp_checksums.sums[self.webapp_name][self.webapp_version]
+            self.load_checksums()
             return 0
-        except ImportError:
-            if self.verbose:
-                print 'unable to open webapp_checksums.py'
         except KeyError:
             if self.verbose:
                 print 'missing checksum for version %s'% (self.webapp_version,)
         # Download needed WP archive and generate checksums
         get_wordpress_checksums.add_checksums(self.webapp_version, verbose=True)
-        reload(webapp_checksums)
-        self.checksums = webapp_checksums.sums[self.webapp_name][self.webapp_version]
+        self.load_checksums()
         return 0
 
     def get_webapp_version(self):
@@ -59,7 +64,7 @@ class WordpressTripwire(WebappTripwire):
         '''
         Return a dict of {file: error}
         '''
-        if not self.get_webapp_version():
+        if not self.detect_webapp_version():
             # this is not Wordpress install
             return {}
         self.get_checksums()
@@ -67,106 +72,261 @@ class WordpressTripwire(WebappTripwire):
 
 ## END class WordpressTripwire(WebappTripwire) ##
 
-## BEGIN wp-cli bits ##
-def get_checksums(addon_type, addon_name, addon_version):
+## BEGIN addon bits ##
+# (type, name, version) of addons downloads.wordpress.org doesn't have,
+# so we only try once - not ones that failed for other reasons
+unavailable_addons = set()
+# (type, name, version) -> when fetching it last failed some other way,
+# e.g. the network was down, it is tried again after RETRY_SECONDS
+failed_addons = {}
+RETRY_SECONDS = 600
+
+def _recently_failed(addon):
+    return time.time() - failed_addons.get(addon, 0) < RETRY_SECONDS
+
+def get_checksums(addon_type, addon_name, addon_version, verbose=False):
     addon_key = 'wordpress-%s-%s'% (addon_type, addon_name)
+    store = ChecksumStore()
     try:
-        import webapp_checksums 
-        return webapp_checksums.sums[addon_key][addon_version]
-    except ImportError:
-        if options.verbose:
-            print 'unable to open webapp_checksums.py'
+        return store.get_reference_set(addon_key, addon_version)
     except KeyError:
-        if options.verbose:
+        if verbose:
             print 'missing checksum for %s version %s'% (addon_key, addon_version,)
+    addon = (addon_type, addon_name, addon_version)
+    if addon in unavailable_addons or _recently_failed(addon):
+        return {}
     # try and download needed WP archive and generate checksums
-    WpAddonChecksums(addon_type, addon_name, addon_version).add_checksums()
     try:
-        reload(webapp_checksums)
-    except NameError:
-        import webapp_checksums
+        WpAddonChecksums(addon_type, addon_name, addon_version).add_checksums()
+    except Exception as e:
+        # network trouble, a bad archive - scan it as unknown for now,
+        # a long running scan_server.py shouldn't give up on it for good
+        if verbose:
+            print 'Unable to fetch checksums for %s version %s: %s'% (addon_key, addon_version, e)
+        failed_addons[addon] = time.time()
+        return {}
     try: 
-        return webapp_checksums.sums[addon_key][addon_version]
+        return store.get_reference_set(addon_key, addon_version)
     except KeyError:
+        unavailable_addons.add(addon)
         return {}
 
+def fetch_addon_md5sums(addon):
+    '''
+    Worker for prefetch_addon_checksums() - addon is (type, name, version)
+    returns (addon, md5sums, error), md5sums is None if it can't be fetched
+    '''
+    addon_type, name, version = addon
+    try:
+        return (addon, WpAddonChecksums(addon_type, name, version).fetch_md5sums(), None)
+    except Exception as e:
+        return (addon, None, e)
+
+def prefetch_addon_checksums(fs_paths, addon_types, workers=8, verbose=False):
+    '''
+    Collect the addons used by every site first and download checksums
+    for each one we don't have yet exactly once, several at a time, so
+    the scans that follow never wait on the network.
+    '''
+    wanted = set()
+    for fs_path in fs_paths:
+        tw = WordpressTripwire(fs_path, verbose=verbose, webapp_name=webapp_name)
+        if not tw.get_webapp_version():
+            continue
+        for addon_type in addon_types:
+            for addon in get_wp_addons(fs_path, addon_type):
+                if addon[0] and addon[3]:
+                    wanted.add((addon_type, addon[0], addon[3]))
+    store = ChecksumStore()
+    missing = [a for a in sorted(wanted - unavailable_addons) if not _recently_failed(a) and not store.has('wordpress-%s-%s'% (a[0], a[1]), a[2])]
+    if verbose:
+        print 'Found %d distinct addon versions, fetching checksums for %d'% (len(wanted), len(missing))
+    if not missing:
+        return 0
+    pool = ThreadPool(min(workers, len(missing)))
+    try:
+        # fetch in worker threads, write to the store from this one
+        for addon, s, error in pool.imap_unordered(fetch_addon_md5sums, missing):
+            if error:
+                # one addon failing doesn't stop the rest, or the scans,
+                # and it may work later so it isn't unavailable
+                if verbose:
+                    print 'Unable to fetch checksums for wordpress-%s-%s version %s: %s'% (addon[0], addon[1], addon[2], error)
+                failed_addons[addon] = time.time()
+            elif s is None:
+                # not on downloads.wordpress.org
+                unavailable_addons.add(addon)
+            else:
+                store.put('wordpress-%s-%s'% (addon[0], addon[1]), addon[2], s)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return len(missing)
+
 def get_wp_plugins_dir(fs_path):
-    return check_output(['/root/webapp_scanner/get_wordpress_plugins_dir', fs_path]).strip()
+    return wp_inventory.get_plugins_dir(fs_path)
 
 def get_wp_themes_dir(fs_path):
-    return check_output(['/root/webapp_scanner/get_wordpress_themes_dir', fs_path]).strip()
+    return wp_inventory.get_themes_dir(fs_path)
 
 def get_wp_plugins(fs_path):
-    cmd = ['/root/webapp_scanner/get_wordpress_plugins', fs_path]
-    return parse_wp_cli_addons(cmd)
+    return wp_inventory.get_plugins(fs_path)
 
 def get_wp_themes(fs_path):
-    cmd = ['/root/webapp_scanner/get_wordpress_themes', fs_path]
-    return parse_wp_cli_addons(cmd)
+    return wp_inventory.get_themes(fs_path)
 
-def scan_wp_addons(fs_path, addon_type):
+# (fs_path, addon type) -> addons, so we only list them once per site
+wp_addons = {}
+
+def get_wp_addons(fs_path, addon_type):
+    try:
+        return wp_addons[(fs_path, addon_type)]
+    except KeyError:
+        pass
     if addon_type == 'plugin':
-        addons_dir = get_wp_plugins_dir(fs_path)
         addons = get_wp_plugins(fs_path)
     elif addon_type == 'theme':
-        addons_dir = get_wp_themes_dir(fs_path)
         addons = get_wp_themes(fs_path)
     else:
         print "unknown WP addon type %s"% (addon_type,)
+        addons = []
+    wp_addons[(fs_path, addon_type)] = addons
+    return addons
+
+def scan_wp_addons(tw, addon_type, addons=None):
+    '''
+    Scan each addon of one type of the site of tw in its own walk,
+    with the same options as tw - addons is a list of the ones to scan,
+    by default all of them
+    Yield (file, error) for each suspect file as it is found
+    '''
+    fs_path = tw.docroot
+    if addon_type == 'plugin':
+        addons_dir = get_wp_plugins_dir(fs_path)
+    elif addon_type == 'theme':
+        addons_dir = get_wp_themes_dir(fs_path)
+    else:
+        print "unknown WP addon type %s"% (addon_type,)
+        return
+    if addons is None:
+        addons = get_wp_addons(fs_path, addon_type)
     for addon in addons:
         name = addon[0]
         version = addon[3]
-        checksums = get_checksums(addon_type, name, version)
+        checksums = get_checksums(addon_type, name, version, tw.verbose)
         if checksums:
             addon_path = join(addons_dir, name)
-            addon_tw = WebappTripwire(addon_path, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files)
+            addon_tw = WebappTripwire(addon_path, verbose=tw.verbose, exclude_files=tw.exclude_files, check_changed_files=tw.check_changed_files, check_new_files=tw.check_new_files, workers=tw.workers, use_threads=tw.use_threads, cache=tw.cache, io_governor=tw.io_governor, readahead=tw.readahead_mode, deadline=tw.deadline, checkpoint_dir=tw.checkpoint_dir)
             addon_tw.checksums = checksums
             addon_tw.webapp_name = name
             addon_tw.webapp_version = version
-            for f, error in addon_tw.scan().iteritems():
-                print '%s %s'% (error, f)
+            for finding in addon_tw.scan_iter():
+                yield finding
 
-def scan_wp_plugins(fs_path):
-    scan_wp_addons(fs_path, 'plugin')
-
-def scan_wp_themes(fs_path):
-    scan_wp_addons(fs_path, 'theme')
+def has_symlink(docroot, rel_dir):
+    '''
+    True if any directory from docroot down to rel_dir is a symlink
+    '''
+    path = docroot
+    for d in rel_dir.split('/'):
+        path = join(path, d)
+        if islink(path):
+            return True
+    return False
 
-def parse_wp_cli_addons(cmd):
+def scan_wp_site(tw, addon_types=[]):
     '''
-    e.g.
-    name    status  update  version
-    Aqua    active  none    2.0
+    Scan WP core plus its plugins and/or themes in a single walk
+    of the docroot. Each addon's checksums are added to the core ones
+    under the addon's directory, so every file is checked against the
+    original it lives under. Addon dirs outside the docroot, or reached
+    through a symlink, which the walk doesn't follow, get their own walk.
+    Yield (file, error) for each suspect file as it is found
     '''
-    results = []
-    validated = False
-    for line in check_output(cmd).strip().split("\n"):
-        name = status = update = version = None
-        if validated:
-            try:
-                (name, status, update, version) = line.split()
-            except ValueError as e:
-                name = line.split()[0]
-            results.append((name, status, update, version))
+    tw.get_checksums()
+    checksums = ReferenceSet(tw.checksums)
+    # [(addon type, addons or None for all of them)] to walk on their own
+    own_walks = []
+    for addon_type in addon_types:
+        if addon_type == 'plugin':
+            addons_dir = get_wp_plugins_dir(tw.docroot)
         else:
-            assert len(line.split()) == 4
-            assert line.split()[0] == 'name'
-            assert line.split()[1] == 'status'
-            assert line.split()[2] == 'update'
-            assert line.split()[3] == 'version'
-            validated = True
-    return results
-## END wp-cli bits ##
-
-def min_version(v1, v2):
+            addons_dir = get_wp_themes_dir(tw.docroot)
+        rel_dir = relpath(addons_dir, tw.docroot)
+        for addon in get_wp_addons(tw.docroot, addon_type):
+            # findings are labelled with the addon, whichever walk finds them
+            tw.owners[tw.get_relative_path(join(addons_dir, addon[0]))] = (addon[0], addon[3])
+        if rel_dir.startswith('..') or has_symlink(tw.docroot, rel_dir):
+            own_walks.append((addon_type, None))
+            continue
+        linked = []
+        for addon in get_wp_addons(tw.docroot, addon_type):
+            if islink(join(addons_dir, addon[0])):
+                linked.append(addon)
+                continue
+            checksums.update(get_checksums(addon_type, addon[0], addon[3], tw.verbose), join(rel_dir, addon[0]))
+        if linked:
+            own_walks.append((addon_type, linked))
+    tw.checksums = checksums
+    # the stored directory index only covers core
+    tw.dir_index = None
+    for finding in tw.scan_iter():
+        yield finding
+    for addon_type, addons in own_walks:
+        for finding in scan_wp_addons(tw, addon_type, addons):
+            yield finding
+
+## END addon bits ##
+
+def get_addon_types(options):
+    addon_types = []
+    if options.scan_plugins:
+        addon_types.append('plugin')
+    if options.scan_themes:
+        addon_types.append('theme')
+    return addon_types
+
+def scan_site(fs_path, options, cache=None, stream=None):
     '''
-    return True if v1 >= v2
-    turn version numbers into lists 
-    so we can use cmp() to see which is greater
+    Do what the command line options say for one path, printing to
+    stream (stdout by default)
+    Return the WordpressTripwire if the path was scanned, else None
     '''
-    v1 = [int(x) for x in v1.split(".")]
-    v2 = [int(x) for x in v2.split(".")]
-    return (cmp(v1, v2) >= 0)
+    if stream is None:
+        stream = sys.stdout
+    if options.unwhitelist_files:
+        tw = WordpressTripwire(verbose=options.verbose, webapp_name=webapp_name)
+        tw.remove_from_whitelist(fs_path)
+        return None
+    tw = WordpressTripwire(fs_path, ignore_files=ignore_files, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files, webapp_name=webapp_name, workers=options.jobs, use_threads=options.use_threads, cache=cache, fingerprint=options.fingerprint, io_governor=io_governor.from_options(options), readahead=options.readahead, deadline=options.deadline, checkpoint_dir=options.checkpoint_dir)
+    if not tw.detect_webapp_version():
+        # this is not Wordpress install
+        return None
+    addon_types = get_addon_types(options)
+    if options.print_version and options.json_lines:
+        addons = {}
+        for addon_type in addon_types:
+            addons[addon_type + 's'] = dict([(a[0], a[3]) for a in get_wp_addons(fs_path, addon_type)])
+        print_details(tw, True, addons, stream)
+    elif options.print_version:
+        print >>stream, tw.get_webapp_details()
+        if options.scan_plugins:
+            print >>stream, 'Plugins:'
+            for p in get_wp_addons(fs_path, 'plugin'):
+                print >>stream, '%s:\t%s'% (p[0], p[3])
+        if options.scan_themes:
+            print >>stream, 'Themes:'
+            for t in get_wp_addons(fs_path, 'theme'):
+                print >>stream, '%s:\t%s'% (t[0], t[3])
+    for f, error in scan_wp_site(tw, addon_types):
+        print_finding(tw, f, error, options.json_lines, stream)
+    # done with this site, list its addons afresh next time
+    for addon_type in ('plugin', 'theme'):
+        wp_addons.pop((fs_path, addon_type), None)
+    return tw
 
 
 if __name__ == '__main__':
@@ -189,6 +349,42 @@ if __name__ == '__main__':
                         dest="whitelist_files", help="add files from scan to whitelist")
     parser.add_option("-u", "--unwhitelist-files", action="store_true", default=False,
                         dest="unwhitelist_files", help="remove files on this path from whitelist")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", action="store", default=1,
+                        help="number of hashing worker processes (default 1, no parallelism)")
+    parser.add_option("--threads", action="store_true", default=False,
+                        dest="use_threads", help="use threads instead of processes for hashing workers")
+    parser.add_option("--cache", dest="cache_file", type="string", action="store", default=None,
+                        help="reuse md5s of files unchanged since the last scan, stored in this file")
+    parser.add_option("--rehash-all", action="store_true", default=False,
+                        dest="rehash_all", help="ignore md5s in the --cache file and hash every file again")
+    parser.add_option("--fetch-jobs", dest="fetch_jobs", type="int", action="store", default=8,
+                        help="number of missing plugin/theme checksums to download at once (default 8)")
+    parser.add_option("--fingerprint", action="store_true", default=False,
+                        dest="fingerprint", help="check the version file against the files themselves, and use the version they match")
+    parser.add_option("--json", action="store_true", default=False,
+                        dest="json_lines", help="print findings as they are found, one JSON object per line")
+    parser.add_option("--watch", action="store_true", default=False,
+                        dest="watch", help="after scanning, keep checking files as they are written (Linux inotify)")
+    parser.add_option("--site-jobs", dest="site_jobs", type="int", action="store", default=1,
+                        help="number of sites to scan at once, each in its own process (default 1)")
+    parser.add_option("--site-timeout", dest="site_timeout", type="int", action="store", default=0,
+                        help="give up on a site after this many seconds (default 0, no limit)")
+    parser.add_option("--max-read-mb", dest="max_read_mb", type="float", action="store", default=0,
+                        help="read at most this many MB/s of files, shared between site owners (default 0, no limit)")
+    parser.add_option("--max-file-rate", dest="max_file_rate", type="float", action="store", default=0,
+                        help="hash at most this many files per second (default 0, no limit)")
+    parser.add_option("--max-load", dest="max_load", type="float", action="store", default=0,
+                        help="slow down while the load average per CPU is over this (default 0, no limit)")
+    parser.add_option("--max-io-pressure", dest="max_io_pressure", type="float", action="store", default=0,
+                        help="slow down while tasks wait on IO more than this %% of the time, from /proc/pressure/io (default 0, no limit)")
+    parser.add_option("--readahead", dest="readahead", type="choice", choices=['inode', 'extent'], action="store", default=None,
+                        help="hash each directory's files in inode or on-disk extent order, reading ahead and dropping them from the page cache afterwards")
+    parser.add_option("--time-budget", dest="time_budget", type="int", action="store", default=0,
+                        help="stop scanning after this many seconds in all (default 0, no limit)")
+    parser.add_option("--checkpoint-dir", dest="checkpoint_dir", type="string", action="store", default=None,
+                        help="save how far unfinished scans got in this directory, and go on from there next time")
+    parser.add_option("--socket", dest="socket_file", type="string", action="store", default=None,
+                        help="have the scan_server.py listening on this Unix socket do the scans")
     parser.add_option("-f", "--from-file", dest="from_file", type="string", action="store",
 		      default=None, help="read file paths from a file (probably a little faster)") 
     # parser.add_option("-e", "--email", dest="email_notify", type="string", action="store") 
@@ -206,36 +402,59 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(1)
  
-    # set() == uniq 
-    for fs_path in sorted(list(set(fs_paths))):
-        if options.unwhitelist_files:
-            tw = WordpressTripwire(verbose=options.verbose, webapp_name=webapp_name)
-            tw.remove_from_whitelist(fs_path)
-        else:
-            tw = WordpressTripwire(fs_path, ignore_files=ignore_files, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files, webapp_name=webapp_name)
-            wp_version = tw.get_webapp_version()
-            if wp_version:
-                if options.scan_plugins or options.scan_themes:
-                    wp_cli_min_version = '3.5.2'
-                    if not min_version(wp_version, wp_cli_min_version):
-                        options.scan_plugins = False
-                        options.scan_themes = False
-                        print "wp-cli plugin and theme scans require WP version %s - you have %s"% (wp_cli_min_version, wp_version)
-                if options.print_version:
-                    print tw.get_webapp_details()
-                    if options.scan_plugins:
-                        print 'Plugins:'
-                        for p in get_wp_plugins(fs_path):
-                            print '%s:\t%s'% (p[0], p[3])
-                    if options.scan_themes:
-                        print 'Themes:'
-                        for t in get_wp_themes(fs_path):
-                            print '%s:\t%s'% (t[0], t[3])
-                if options.scan_plugins:
-                    scan_wp_plugins(fs_path)
-                if options.scan_themes:
-                    scan_wp_themes(fs_path)
-            tw = WordpressTripwire(fs_path, ignore_files=ignore_files, verbose=options.verbose, exclude_files=options.whitelist_files, check_changed_files=options.find_changed_files, check_new_files=options.find_new_files, webapp_name=webapp_name)
-            for f, error in tw.scan_core().iteritems():
-                print '%s %s'% (error, f)
+    options.deadline = None
+    if options.time_budget:
+        options.deadline = time.time() + options.time_budget
+    if options.checkpoint_dir and not os.path.isdir(options.checkpoint_dir):
+        os.makedirs(options.checkpoint_dir)
+
+    # in JSON mode stdout is only findings, anything else we print is
+    # for people and goes to stderr
+    findings_out = sys.stdout
+    if options.json_lines:
+        sys.stdout = sys.stderr
 
+    if options.socket_file:
+        if options.watch:
+            print "--watch can't be used with --socket"
+            sys.exit(1)
+        for fs_path in sorted(list(set(fs_paths))):
+            request_scan(options.socket_file, 'wordpress', fs_path, options, findings_out)
+        sys.exit(0)
+
+    cache = None
+    if options.cache_file:
+        cache = ScanCache(options.cache_file, rehash_all=options.rehash_all, verbose=options.verbose)
+        cache.load()
+
+    addon_types = get_addon_types(options)
+    if addon_types and not options.unwhitelist_files:
+        prefetch_addon_checksums(sorted(set(fs_paths)), addon_types, options.fetch_jobs, options.verbose)
+
+    # scanned sites, kept for --watch
+    watched = []
+    # whitelist changes are made one site at a time in this process,
+    # separate processes would each write back their own copy of it
+    if (options.site_jobs > 1 or options.site_timeout) and not (options.whitelist_files or options.unwhitelist_files):
+        if options.watch:
+            print "--watch can't be used with --site-jobs or --site-timeout"
+            sys.exit(1)
+        # the read budgets are for the whole run, split between the processes
+        options.max_read_mb /= max(options.site_jobs, 1)
+        options.max_file_rate /= max(options.site_jobs, 1)
+        scan_fleet(scan_site, sorted(list(set(fs_paths))), options, cache, options.site_jobs, options.site_timeout, findings_out)
+    else:
+        # set() == uniq 
+        for fs_path in sorted(list(set(fs_paths))):
+            tw = scan_site(fs_path, options, cache, findings_out)
+            if options.watch and tw:
+                watched.append(tw)
+    if cache:
+        cache.save()
+    if options.watch and watched:
+        try:
+            watch(watched, options.json_lines, options.verbose, findings_out)
+        except KeyboardInterrupt:
+            pass
+        if cache:
+            cache.save()
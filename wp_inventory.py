@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+List WordPress plugins and themes by reading their file headers,
+the same way WordPress itself does, without running PHP or wp-cli
+
+e.g. the top of wp-content/plugins/akismet/akismet.php
+/*
+Plugin Name: Akismet Anti-Spam
+Version: 4.1.3
+*/
+'''
+
+import os
+import re
+import sys
+from optparse import OptionParser
+
+# WordPress' get_file_data() only looks at the first 8 KB
+HEADER_BYTES = 8192
+
+def read_file_headers(path, headers):
+    '''
+    {header: value} for the headers found in a plugin file or theme style.css
+    '''
+    try:
+        f = open(path)
+        try:
+            data = f.read(HEADER_BYTES)
+        finally:
+            f.close()
+    except IOError:
+        return {}
+    data = data.replace('\r', '\n')
+    found = {}
+    for header in headers:
+        m = re.search(r'^(?:[ \t]*<\?php)?[ \t/*#@]*' + re.escape(header) + r':(.*)$', data, re.M | re.I)
+        if m:
+            # _cleanup_header_comment()
+            found[header] = re.sub(r'\s*(?:\*/|\?>).*', '', m.group(1)).strip()
+    return found
+
+def get_wp_config_define(fs_path, constant):
+    '''
+    Directory a wp-config.php define() points at, for the usual forms
+    define('WP_CONTENT_DIR', '/path');
+    define('WP_CONTENT_DIR', dirname(__FILE__) . '/path');
+    '''
+    try:
+        f = open(os.path.join(fs_path, 'wp-config.php'))
+        config = f.read()
+        f.close()
+    except IOError:
+        return None
+    m = re.search(r'''define\s*\(\s*['"]%s['"]\s*,\s*(.*?)\s*\)\s*;'''% (constant,), config)
+    if not m:
+        return None
+    value = m.group(1)
+    m = re.match(r'''^(?:dirname\s*\(\s*__FILE__\s*\)|__DIR__)\s*\.\s*['"]([^'"]*)['"]$''', value)
+    if m:
+        return os.path.join(fs_path, m.group(1).lstrip('/'))
+    m = re.match(r'''^['"]([^'"]*)['"]$''', value)
+    if m:
+        return m.group(1)
+    # computed at runtime, can't tell
+    return None
+
+def get_content_dir(fs_path):
+    return get_wp_config_define(fs_path, 'WP_CONTENT_DIR') or os.path.join(fs_path, 'wp-content')
+
+def get_plugins_dir(fs_path):
+    return get_wp_config_define(fs_path, 'WP_PLUGIN_DIR') or os.path.join(get_content_dir(fs_path), 'plugins')
+
+def get_themes_dir(fs_path):
+    return os.path.join(get_content_dir(fs_path), 'themes')
+
+def _listdir(d):
+    try:
+        return sorted(os.listdir(d))
+    except OSError:
+        return []
+
+def get_plugins(fs_path):
+    '''
+    [(name, status, update, version)] like wp-cli plugin list
+    status and update need the database, so they are None
+    Plugins are .php files with a Plugin Name header, either directly in
+    the plugins dir or one level down - the same places WordPress looks
+    '''
+    plugins_dir = get_plugins_dir(fs_path)
+    results = []
+    for entry in _listdir(plugins_dir):
+        path = os.path.join(plugins_dir, entry)
+        if os.path.isdir(path):
+            candidates = [os.path.join(path, f) for f in _listdir(path) if f.endswith('.php')]
+            name = entry
+        elif entry.endswith('.php'):
+            candidates = [path]
+            name = entry[:-len('.php')]
+        else:
+            continue
+        for candidate in candidates:
+            headers = read_file_headers(candidate, ['Plugin Name', 'Version'])
+            if headers.get('Plugin Name'):
+                results.append((name, None, None, headers.get('Version')))
+                break
+    return results
+
+def get_themes(fs_path):
+    '''
+    [(name, status, update, version)] like wp-cli theme list
+    Themes are directories with a style.css that has a Theme Name header
+    '''
+    themes_dir = get_themes_dir(fs_path)
+    results = []
+    for entry in _listdir(themes_dir):
+        headers = read_file_headers(os.path.join(themes_dir, entry, 'style.css'), ['Theme Name', 'Version'])
+        if headers.get('Theme Name'):
+            results.append((entry, None, None, headers.get('Version')))
+    return results
+
+
+if __name__ == '__main__':
+    usage = '%s path [path path] \n'% (os.path.basename(__file__),)
+    usage += 'e.g. %s /users/bubba/public_html/bubba.com \n'% (os.path.basename(__file__),)
+    usage += '''
+List the plugins and themes of WordPress sites and their versions
+    '''
+    parser = OptionParser(usage=usage)
+    (options, fs_paths) = parser.parse_args()
+    if not fs_paths:
+        parser.print_help()
+        sys.exit(1)
+    for fs_path in fs_paths:
+        print fs_path
+        print 'Plugins:'
+        for p in get_plugins(fs_path):
+            print '%s:\t%s'% (p[0], p[3])
+        print 'Themes:'
+        for t in get_themes(fs_path):
+            print '%s:\t%s'% (t[0], t[3])